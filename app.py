@@ -1,10 +1,28 @@
 import streamlit as st
 import os
+import time
 import pandas as pd
-from loader import load_xdf, load_evaluation_data
-from preprocess import apply_filters, create_epochs
-from features import calculate_features_sliding_window
-from utils_plot import plot_waveforms, plot_outlier_scatter
+from loader import load_xdf, load_evaluation_data, list_signal_files, purge_signal_files, CACHE_DIR
+from preprocess import apply_filters, create_epochs, select_channels
+from features import FEATURE_NAMES, WINDOW_SIZE_SEC, STEP_SIZE_SEC
+from utils_plot import plot_waveforms, plot_outlier_scatter, plot_rejection_curves, figure_payload_bytes
+from feature_table import FeatureTable
+from rejection import rejection_sample_mask, export_masked_continuous, export_cleaned_epochs, export_to_bytes
+from scan_worker import scan_params, submit_scan
+import feature_store
+import instrumentation
+
+# 処理モジュールはStreamlitに依存しないため、キャッシュはここで付ける
+cached_load_xdf = st.cache_resource(show_spinner="XDFファイルを解析中...")(load_xdf)
+cached_load_evaluation_data = st.cache_data(show_spinner="評価データを解析中...")(load_evaluation_data)
+
+# スキャン実行中に画面を更新する間隔（秒）
+SCAN_POLL_SEC = 0.5
+# スキャンのプロファイルの書き出し先
+PROFILE_DIR = os.path.join(CACHE_DIR, 'profiles')
+# サイドバーで選べるウィンドウ長とステップ（秒）
+WINDOW_SIZE_OPTIONS = [0.25, 0.5, 1.0, 2.0]
+STEP_SIZE_OPTIONS = [0.02, 0.05, 0.1, 0.2, 0.25, 0.5]
 
 # --- 初期設定と認証 ---
 st.set_page_config(page_title="EEG Precision Artifact Removal", page_icon="🧠", layout="wide")
@@ -22,7 +40,7 @@ def check_password():
 
 # --- セッション状態管理 ---
 def initialize_session_state():
-    keys = ["eeg_data", "eval_data", "features_df", "outlier_windows_df"]
+    keys = ["eeg_data", "eval_data", "feature_table", "outlier_rows", "scan_job"]
     for key in keys:
         if key not in st.session_state: st.session_state[key] = None
 
@@ -31,51 +49,174 @@ def sidebar_controls():
     st.sidebar.title("📁 ファイル")
     xdf_file = st.sidebar.file_uploader("1. XDFファイル", type=['xdf'])
     eval_file = st.sidebar.file_uploader("2. 試行情報ファイル", type=['csv', 'xlsx'])
-    if xdf_file and st.session_state.eeg_data is None: st.session_state.eeg_data = load_xdf(xdf_file)
-    if eval_file and st.session_state.eval_data is None: st.session_state.eval_data = load_evaluation_data(eval_file)
+    compact_load = st.sidebar.checkbox("省メモリ読み込み (float32)", value=False, help="信号をfloat32で保持します（読み込み前に設定してください）")
+    if xdf_file and st.session_state.eeg_data is None:
+        try:
+            with instrumentation.run('load', file=xdf_file.name):
+                eeg_data = cached_load_xdf(xdf_file, dtype='float32' if compact_load else None)
+            st.info(f"{len(eeg_data['eeg_stream']['ch_names'])}チャンネルを読み込みました: {', '.join(eeg_data['eeg_stream']['ch_names'])}")
+            if eeg_data['markers'].empty: st.warning("マーカーストリームが見つかりませんでした。")
+            stats = eeg_data['load_stats']
+            rss_text = f", 読み込み中のメモリ増加: {stats['load_rss_mb']:.0f} MB" if stats['load_rss_mb'] is not None else ""
+            st.success(f"EEGデータ読み込み完了 (SampleRate: {eeg_data['eeg_stream']['sfreq']} Hz, 信号: {stats['payload_mb']:.1f} MB{rss_text})")
+            st.session_state.eeg_data = eeg_data
+        except ValueError as e: st.error(str(e))
+    if eval_file and st.session_state.eval_data is None:
+        try:
+            st.session_state.eval_data = cached_load_evaluation_data(eval_file)
+            st.success(f"評価データ読み込み完了 ({len(st.session_state.eval_data)}件)")
+        except ValueError as e: st.error(str(e))
     
+    channels = []
+    if st.session_state.eeg_data is not None:
+        st.sidebar.markdown("---"); st.sidebar.title("📡 チャンネル")
+        ch_names = st.session_state.eeg_data['eeg_stream']['ch_names']
+        channels = st.sidebar.multiselect("解析するチャンネル", ch_names, default=ch_names[:2])
+
     st.sidebar.markdown("---"); st.sidebar.title("🔧 フィルター設定")
     freq_range = st.sidebar.slider("バンドパス (Hz)", 0.5, 60.0, (1.0, 50.0), 0.5)
     notch_filter = st.sidebar.checkbox("50Hz ノッチ", value=True)
+    if st.session_state.eeg_data is not None:
+        nyquist = 0.5 * st.session_state.eeg_data['eeg_stream']['sfreq']
+        if freq_range[1] >= nyquist: st.sidebar.error(f"高域カットオフ周波数がナイキスト周波数({nyquist}Hz)以上です。")
     
     st.sidebar.markdown("---"); st.sidebar.title("⏰ 解析時間範囲")
     time_range = st.sidebar.slider("マーカーからの時間(秒)", -5.0, 15.0, (0.0, 10.0), 0.5, help="特徴量計算と波形表示の基本範囲です")
-    return {'freq_range': freq_range, 'notch_filter': notch_filter, 'time_range': time_range}
+    continuous_scan = st.sidebar.checkbox("連続スキャン", value=False, help="記録全体を1回だけスキャンし、重なり合うエポック間で計算結果を共有します（試行間隔が解析時間範囲より短い場合に高速）")
+
+    st.sidebar.markdown("---"); st.sidebar.title("🪟 ウィンドウ")
+    window_size = st.sidebar.select_slider("ウィンドウ長 (秒)", WINDOW_SIZE_OPTIONS, value=WINDOW_SIZE_SEC)
+    step_size = st.sidebar.select_slider("ステップ (秒)", STEP_SIZE_OPTIONS, value=STEP_SIZE_SEC, help="小さいほどウィンドウの重なりが大きく、計算量が増えます")
+    multi_resolution = st.sidebar.checkbox("全てのウィンドウ長をまとめて計算", value=False, help="他のウィンドウ長も同じスキャンで計算して保存し、切り替えたときは再計算せずに読み込みます")
+
+    st.sidebar.markdown("---")
+    with st.sidebar.expander("💾 特徴量キャッシュ"):
+        entries = feature_store.list_entries()
+        st.caption(f"{len(entries)}件 / {entries['size_mb'].sum():.1f} MB")
+        if not entries.empty: st.dataframe(entries[['key', 'rows', 'size_mb', 'last_used']], hide_index=True)
+        if st.button("キャッシュを全削除", disabled=entries.empty): feature_store.purge(); st.rerun()
+        signal_files = list_signal_files()
+        st.caption(f"信号のメモリマップ: {len(signal_files)}件 / {signal_files['size_mb'].sum():.1f} MB")
+        if st.button("メモリマップを全削除", disabled=signal_files.empty, help="次の読み込み時に作り直されます"): purge_signal_files(); st.rerun()
+    instrumentation_panel()
+    return {'channels': channels, 'freq_range': freq_range, 'notch_filter': notch_filter, 'time_range': time_range, 'continuous_scan': continuous_scan,
+            'window_size': window_size, 'step_size': step_size, 'multi_resolution': multi_resolution}
+
+def controls_scan_params(controls):
+    return scan_params(controls['channels'], controls['freq_range'], controls['notch_filter'], controls['time_range'], controls['continuous_scan'],
+                       window_size_sec=controls['window_size'], step_size_sec=controls['step_size'],
+                       window_sizes=WINDOW_SIZE_OPTIONS if controls['multi_resolution'] else None)
+
+def instrumentation_panel():
+    """処理段ごとの計測結果（直近の読み込み・スキャン・描画）とプロファイルの取得"""
+    with st.sidebar.expander("🩺 計測"):
+        enabled = st.checkbox("処理時間・メモリを計測する", value=instrumentation.is_enabled(), help="サーバー全体で有効になります")
+        if enabled != instrumentation.is_enabled(): instrumentation.enable(enabled)
+        # スキャンを投入したら次の再実行でチェックを外す（ウィジェットの値は描画前にしか変更できない）
+        if st.session_state.pop('profile_consumed', False): st.session_state.profile_next_scan = False
+        st.checkbox("次のスキャンをプロファイルする", key='profile_next_scan')
+        for name, report in instrumentation.last_runs().items():
+            peak_text = f", ピーク {report['peak_mb']:.1f} MB" if report['peak_mb'] is not None else ""
+            if report.get('peak_shared'): peak_text = ", ピーク 測定不可（他の処理と並行）"
+            st.caption(f"{name} ({report['time']}): {report['wall_sec'] * 1000:.0f} ms, CPU {report['cpu_sec'] * 1000:.0f} ms{peak_text}")
+            if not report['stages']: continue
+            st.dataframe(pd.DataFrame([{
+                '段': '　' * (r['depth'] - 1) + r['stage'],
+                'ms': r['wall_sec'] * 1000,
+                'CPU ms': r['cpu_sec'] * 1000,
+                'MB': r['peak_mb'],
+                '件数': ', '.join(f"{k}={v}" for k, v in r['items'].items())
+            } for r in report['stages']]), hide_index=True)
+        profile_path = st.session_state.get('profile_path')
+        if profile_path and os.path.exists(profile_path):
+            with open(profile_path, 'rb') as f:
+                st.download_button("⬇️ プロファイル (folded)", f.read(), file_name=os.path.basename(profile_path), help="flamegraph.pl や speedscope で表示できます")
 
 # --- 外れ値除去タブ ---
+def scan_progress_panel(job):
+    """実行中のスキャンの進捗・中断ボタン・途中結果の散布図"""
+    unit = "ブロック" if job.params['continuous'] else "試行"
+    progress_text = f"{job.stage}: {job.done} / {job.total} {unit}" if job.total else f"{job.stage}..."
+    st.progress(job.fraction, text=progress_text)
+    if st.button("⏹ スキャンを中断"): job.cancel(); st.rerun()
+
+    partial = job.partial_frame()
+    if partial is None or partial.empty: return
+    ch = job.params['channels'][0]
+    ch_df = partial[partial['channel'] == ch]
+    eval_data = st.session_state.eval_data
+    eval_cols = [] if eval_data is None else [c for c in eval_data.columns if c not in ['sid', 'img_id', 'time']]
+    if eval_cols: ch_df, color_col = pd.merge(ch_df, eval_data, on='img_id', how='left'), eval_cols[0]
+    else: color_col = 'img_id'
+    st.caption(f"途中結果: {ch} の {len(ch_df)} ウィンドウ")
+    st.plotly_chart(plot_outlier_scatter(ch_df, 'delta', 'amplitude', color_col), use_container_width=True)
+
+def poll_scan_job(controls):
+    """バックグラウンドのスキャンを確認する。実行中なら True（設定が変わっていれば中断を要求する）"""
+    job = st.session_state.scan_job
+    if job is None: return False
+    current = controls_scan_params(controls)
+    if not job.finished_running and job.params != current:
+        job.cancel(); st.warning("設定が変更されたため、スキャンを中断しました。")
+    if not job.finished_running: scan_progress_panel(job); return True
+
+    st.session_state.scan_job = None
+    if job.status == 'cancelled': st.info("スキャンを中断しました。"); return False
+    if job.status == 'error': st.error(f"スキャンに失敗しました: {job.error}"); return False
+    features_df = job.result
+    n_ch = len(job.params['channels'])
+    if job.from_store: st.success(f"保存済みの特徴量を読み込みました（{len(features_df)}行）。")
+    elif features_df.empty: st.warning("特徴量を計算できるデータがありませんでした。")
+    else: st.success(f"{len(features_df) // n_ch}個の微小区間（ウィンドウ {job.params['window_size_sec']} 秒）× {n_ch}チャンネルが生成されました（{job.finished - job.started:.1f} 秒）。")
+    # 以降の再実行では、この圧縮済みの表と行番号だけを使う（評価データも行番号で引く）
+    with instrumentation.stage('app.feature_table', rows=len(features_df)):
+        st.session_state.feature_table = None if features_df.empty else FeatureTable(features_df, st.session_state.eval_data)
+    st.session_state.outlier_rows = None
+    return False
+
 def outlier_rejection_tab(controls):
     st.header("🔬 アーチファクトの検出と除去")
     if st.session_state.eeg_data is None: st.warning("XDFファイルをアップロードしてください。"); return
     
-    if st.button("📈 精密スキャンを実行", type="primary"):
-        with st.spinner("スライディングウィンドウで特徴量を計算中..."):
-            filtered_eeg = apply_filters(st.session_state.eeg_data, controls['freq_range'], controls['notch_filter'])
-            features_df = calculate_features_sliding_window(filtered_eeg, controls['time_range'])
-            st.session_state.features_df = features_df
-            st.session_state.outlier_windows_df = pd.DataFrame()
-            st.success(f"{len(features_df)}個の微小区間（ウィンドウ）が生成されました。")
+    if st.button("📈 精密スキャンを実行", type="primary", disabled=not controls['channels']):
+        # 前のスキャンが残っていれば中断し、新しい条件で投入する（計算はワーカースレッドで行う）
+        if st.session_state.scan_job is not None: st.session_state.scan_job.cancel()
+        params = controls_scan_params(controls)
+        profile_path = None
+        if st.session_state.get('profile_next_scan'):
+            profile_path = os.path.join(PROFILE_DIR, f"scan-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            st.session_state.profile_path = profile_path
+            st.session_state.profile_consumed = True  # プロファイルは指定した次の1回だけ
+        st.session_state.scan_job = submit_scan(st.session_state.eeg_data, params, profile_path)
+        st.session_state.feature_table = None
+    if not controls['channels']: st.warning("解析するチャンネルをサイドバーで選択してください。")
+    if poll_scan_job(controls): return
 
-    if st.session_state.features_df is None or st.session_state.features_df.empty:
-        st.info("上のボタンを押して、特徴量計算を開始してください。"); return
+    table = st.session_state.feature_table
+    if table is None: st.info("上のボタンを押して、特徴量計算を開始してください。"); return
+    table.attach_eval(st.session_state.eval_data)
 
     st.markdown("---"); st.subheader("📊 散布図によるアーチファクトの可視化と除去")
-    df = st.session_state.features_df
-    ch_select = st.radio("対象チャンネル", ["Fp1", "Fp2"], horizontal=True)
+    if len(table.channels) <= 8: ch_select = st.radio("対象チャンネル", table.channels, horizontal=True)
+    else: ch_select = st.selectbox("対象チャンネル", table.channels)
+    # 閾値索引はチャンネルごとに初回だけ作り、部分集合は表の行番号で持つ
+    rows, index = table.channel_rows(ch_select), table.threshold_index(ch_select)
     
     st.markdown("##### 除去する閾値を設定（いずれか一つでも超えたら除去）")
     thresholds = {}
     cols = st.columns(3)
-    bands = ['amplitude', 'delta', 'theta', 'alpha', 'beta', 'gamma']
+    bands = FEATURE_NAMES
     for i, band in enumerate(bands):
-        key = f'{ch_select}_{band}'
-        if key in df.columns:
-            thresholds[key] = cols[i % 3].number_input(f"{key} の上限", value=df[key].quantile(0.99))
+        thresholds[band] = cols[i % 3].number_input(f"{ch_select}_{band} の上限", value=float(index.quantile(band, 0.99)))
 
     if thresholds:
-      query = " | ".join([f"`{key}` >= {val}" for key, val in thresholds.items()])
-      outliers = df.query(query)
-      st.session_state.outlier_windows_df = outliers
-      st.metric("除去された微小区間（ウィンドウ）の数", len(outliers), f"-{len(outliers) / len(df):.1%}" if len(df) > 0 else "")
+      outlier_rows = rows[index.rejection_mask(thresholds)]
+      st.session_state.outlier_rows = outlier_rows
+      st.metric("除去された微小区間（ウィンドウ）の数", len(outlier_rows), f"-{len(outlier_rows) / len(rows):.1%}" if len(rows) > 0 else "")
+      st.caption(f"特徴量表: {len(table.df)}行 / {table.memory_mb():.1f} MB")
+      with st.expander("📉 閾値と除去率の関係"):
+          st.plotly_chart(plot_rejection_curves(index, list(thresholds), thresholds), use_container_width=True)
     
     # ★★ ここからUIを刷新 ★★
     st.markdown("##### 表示するグラフの軸と凡例を選択")
@@ -83,41 +224,66 @@ def outlier_rejection_tab(controls):
         st.warning("凡例（色分け）を使用するには、試行情報ファイルをアップロードしてください。")
         return
         
-    feature_cols = [f'{ch_select}_{b}' for b in bands]
-    eval_cols = [c for c in st.session_state.eval_data.columns if c not in ['sid', 'img_id', 'time']]
+    feature_cols = bands
+    eval_cols = table.eval_columns
     
     col1, col2, col3 = st.columns(3)
-    x_axis = col1.selectbox("X軸（EEG特徴量）", feature_cols, index=1) # delta
-    y_axis = col2.selectbox("Y軸（EEG特徴量）", feature_cols, index=0) # amplitude
+    x_axis = col1.selectbox("X軸（EEG特徴量）", feature_cols, index=1, format_func=lambda b: f'{ch_select}_{b}') # delta
+    y_axis = col2.selectbox("Y軸（EEG特徴量）", feature_cols, index=0, format_func=lambda b: f'{ch_select}_{b}') # amplitude
     color_axis = col3.selectbox("凡例/色（主観評価）", eval_cols)
 
-    if x_axis in df.columns and y_axis in df.columns and color_axis in st.session_state.eval_data.columns:
-        plot_df = pd.merge(df, st.session_state.eval_data, on='img_id', how='left')
+    if color_axis in eval_cols:
+        plot_df = table.channel_frame(ch_select, [x_axis, y_axis], [color_axis])
         fig = plot_outlier_scatter(plot_df, x_axis, y_axis, color_axis, thresholds.get(x_axis), thresholds.get(y_axis))
         st.plotly_chart(fig, use_container_width=True)
+        st.caption(f"描画データ量: {figure_payload_bytes(fig) / 1024:.0f} KB")
     # ★★ ここまで ★★
 
 # --- 除去後波形タブ ---
 def post_rejection_viewer_tab(controls):
     st.header("👀 除去後の波形確認")
-    if st.session_state.outlier_windows_df is None or st.session_state.outlier_windows_df.empty:
+    table, outlier_rows = st.session_state.feature_table, st.session_state.outlier_rows
+    if table is None or outlier_rows is None or len(outlier_rows) == 0:
         st.info("左のタブで閾値を設定すると、除去された区間がここに表示されます。"); return
 
-    filtered_eeg = apply_filters(st.session_state.eeg_data, controls['freq_range'], controls['notch_filter'])
-    outlier_img_ids = st.session_state.outlier_windows_df['img_id'].unique()
+    outlier_channel = table.df['channel'].iloc[outlier_rows[0]]
+    view_channels = st.multiselect("表示するチャンネル", table.channels, default=[outlier_channel])
+    if not view_channels: st.info("表示するチャンネルを選択してください。"); return
+    raw_eeg = select_channels(st.session_state.eeg_data, view_channels)
+    filtered_eeg = apply_filters(raw_eeg, controls['freq_range'], controls['notch_filter'])
+    outlier_img_ids = pd.unique(table.df['img_id'].to_numpy()[outlier_rows])
     img_id_to_view = st.selectbox("確認する画像IDを選択", outlier_img_ids)
     
-    st.info(f"画像ID: {img_id_to_view} の波形。赤色でハイライトされた区間が除去された微小区間です。")
+    st.info(f"画像ID: {img_id_to_view} の波形。赤色でハイライトされた区間が {outlier_channel} の閾値で除去された微小区間です。")
     
-    raw_epoch = create_epochs(st.session_state.eeg_data, img_id_to_view, controls['time_range'])
+    raw_epoch = create_epochs(raw_eeg, img_id_to_view, controls['time_range'])
     filtered_epoch = create_epochs(filtered_eeg, img_id_to_view, controls['time_range'])
     
     if raw_epoch and filtered_epoch:
-        plot_data = {'raw': raw_epoch['data'], 'filtered': filtered_epoch['data'], 'times': raw_epoch['times'], 'time_range': controls['time_range']}
-        outliers_for_plot = st.session_state.outlier_windows_df[st.session_state.outlier_windows_df['img_id'] == img_id_to_view]
+        plot_data = {'raw': raw_epoch['data'], 'filtered': filtered_epoch['data'], 'times': raw_epoch['times'], 'time_range': controls['time_range'], 'ch_names': view_channels}
+        outliers_for_plot = table.frame(table.rows_for_trial(outlier_rows, img_id_to_view))
         outliers_for_plot_renamed = outliers_for_plot.rename(columns={'window_start_sec': 'second', 'window_end_sec': 'second_end'})
-        fig = plot_waveforms(plot_data, display_mode="並べて", outlier_df=outliers_for_plot_renamed)
+        t_min, t_max = float(raw_epoch['times'][0]), float(raw_epoch['times'][-1])
+        x_range = st.slider("表示範囲(秒)", t_min, t_max, (t_min, t_max), help="範囲を狭めると、その区間をより高い解像度で再描画します")
+        fig = plot_waveforms(plot_data, display_mode="並べて", outlier_df=outliers_for_plot_renamed, x_range=x_range)
         st.plotly_chart(fig, use_container_width=True)
+        st.caption(f"描画データ量: {figure_payload_bytes(fig) / 1024:.0f} KB")
+
+    st.markdown("---"); st.subheader("💾 除去済みデータの書き出し")
+    col1, col2, col3 = st.columns(3)
+    export_kind = col1.radio("書き出す内容", ["連続信号", "エポック"], horizontal=True)
+    export_source = col2.radio("信号", ["フィルター後", "生データ"], horizontal=True)
+    export_fmt = col3.radio("形式", ["npz", "parquet"], horizontal=True)
+    if st.button("書き出しデータを作成"):
+        source = filtered_eeg if export_source == "フィルター後" else raw_eeg
+        mask = rejection_sample_mask(source, table.frame(outlier_rows), controls['time_range'])
+        try:
+            if export_kind == "連続信号": data = export_to_bytes(export_masked_continuous, source, mask, fmt=export_fmt)
+            else: data = export_to_bytes(export_cleaned_epochs, source, mask, controls['time_range'], fmt=export_fmt)
+        except ImportError as e: st.error(str(e)); return
+        st.caption(f"除去されたサンプル: {mask.sum()} / {len(mask)} ({mask.mean():.1%})")
+        file_name = f"cleaned_{'continuous' if export_kind == '連続信号' else 'epochs'}.{export_fmt}"
+        st.download_button("⬇️ ダウンロード", data, file_name=file_name, mime="application/octet-stream")
 
 # --- メイン実行部 ---
 def main():
@@ -126,7 +292,10 @@ def main():
     st.title("🧠 EEG 精密アーチファクト除去ツール")
     controls = sidebar_controls()
     tab1, tab2 = st.tabs(["🔬 アーチファクトの検出・除去", "👀 除去後の波形確認"])
-    with tab1: outlier_rejection_tab(controls)
-    with tab2: post_rejection_viewer_tab(controls)
+    with instrumentation.run('render'):
+        with tab1: outlier_rejection_tab(controls)
+        with tab2: post_rejection_viewer_tab(controls)
+    # スキャン中は一定間隔で再実行して進捗と途中結果を更新する
+    if st.session_state.scan_job is not None: time.sleep(SCAN_POLL_SEC); st.rerun()
 
 if __name__ == "__main__": main()
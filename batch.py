@@ -0,0 +1,189 @@
+"""
+複数のXDFファイルを一括でスキャンするコマンドラインツール（Streamlit不要）。
+
+    python batch.py <XDFディレクトリ> <出力ディレクトリ> --thresholds thresholds.json --workers 4
+
+ファイルごとに以下を出力する。完了済みファイル（同じ条件で書いた .done.json があるもの）は再実行時にスキップされる。
+    <名前>.features.csv   ウィンドウごとの特徴量（rejected 列付き）
+    <名前>.rejected.npy   ウィンドウごとの除去マスク
+    <名前>.clean.npz      除去サンプルを NaN にした連続信号（--export-clean 指定時）
+    <名前>.done.json      処理結果の要約
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from loader import load_xdf
+from preprocess import apply_filters
+from features import calculate_features_sliding_window, rejection_mask, FEATURE_NAMES, WINDOW_SIZE_SEC, STEP_SIZE_SEC
+from rejection import rejection_sample_mask, export_masked_continuous
+from instrumentation import run
+
+logger = logging.getLogger('batch')
+
+def _output_paths(xdf_path, out_dir):
+    stem = os.path.join(out_dir, os.path.splitext(os.path.basename(xdf_path))[0])
+    return {'features': f"{stem}.features.csv", 'mask': f"{stem}.rejected.npy", 'clean': f"{stem}.clean.npz", 'done': f"{stem}.done.json"}
+
+def _run_params(thresholds, freq_range, notch_filter, time_range, continuous, export_clean, channels, layout, window_size_sec, step_size_sec):
+    # 出力内容を左右する条件（.done.json に記録し、再実行時に同じ条件のファイルだけをスキップする）
+    return {
+        'thresholds': {str(key): float(val) for key, val in thresholds.items()},
+        'freq_range': [float(v) for v in freq_range],
+        'notch_filter': bool(notch_filter),
+        'time_range': [float(v) for v in time_range],
+        'continuous': bool(continuous),
+        'export_clean': bool(export_clean),
+        'channels': None if channels is None else [str(ch) for ch in channels],
+        'layout': layout,
+        'window_size_sec': float(window_size_sec),
+        'step_size_sec': float(step_size_sec)
+    }
+
+def _is_done(done_path, params):
+    # 完了マーカーが無い・壊れている・条件が違う場合は処理し直す
+    try:
+        with open(done_path, encoding='utf-8') as f: return json.load(f).get('params') == params
+    except (OSError, ValueError):
+        return False
+
+def _limit_worker_memory(max_worker_mb):
+    # ワーカー1つあたりの仮想メモリ上限（Unixのみ）
+    if max_worker_mb is None: return
+    try:
+        import resource
+    except ImportError:
+        return
+    limit = int(max_worker_mb * 1024 ** 2)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _threshold_keys(features_df, layout):
+    # long 形式では特徴量名（全チャンネル）と「チャンネル_特徴量」の両方を受け付ける
+    if layout == 'wide': return set(features_df.columns)
+    channels = features_df['channel'].cat.categories
+    return set(FEATURE_NAMES) | {f"{ch}_{feat}" for ch in channels for feat in FEATURE_NAMES}
+
+def process_file(xdf_path, out_dir, thresholds, freq_range, notch_filter, time_range, continuous, export_clean=False,
+                 channels=None, layout='wide', window_size_sec=WINDOW_SIZE_SEC, step_size_sec=STEP_SIZE_SEC):
+    """1ファイル分の読み込み→フィルター→特徴量→除去マスク→書き出し"""
+    start = time.perf_counter()
+    paths = _output_paths(xdf_path, out_dir)
+    with run('batch_file', file=os.path.basename(xdf_path)):
+        # 指定したチャンネルだけを読み込む（全チャンネル分の配列をワーカーに持たせない）
+        eeg_data = load_xdf(xdf_path, use_memmap=False, channels=channels)
+        filtered_eeg = apply_filters(eeg_data, freq_range, notch_filter)
+        features_df = calculate_features_sliding_window(filtered_eeg, time_range, continuous=continuous, layout=layout,
+                                                        window_size_sec=window_size_sec, step_size_sec=step_size_sec)
+
+        if features_df.empty:
+            # ウィンドウが1つも無いファイルも空の結果と完了マーカーを書く（再実行のたびにやり直さない）
+            logger.warning("%s: 特徴量を計算できるデータがありませんでした", os.path.basename(xdf_path))
+            usable = {}
+        else:
+            valid_keys = _threshold_keys(features_df, layout)
+            usable = {key: val for key, val in thresholds.items() if key in valid_keys}
+            unknown = sorted(set(thresholds) - set(usable))
+            if unknown: logger.warning("%s: 特徴量に存在しない閾値キーを無視します %s", os.path.basename(xdf_path), unknown)
+        mask = rejection_mask(features_df, usable)
+        features_df['rejected'] = mask
+        features_df.to_csv(paths['features'], index=False)
+        np.save(paths['mask'], mask)
+        if export_clean:
+            sample_mask = rejection_sample_mask(filtered_eeg, features_df[mask], time_range)
+            export_masked_continuous(filtered_eeg, sample_mask, paths['clean'])
+
+    summary = {
+        'file': os.path.basename(xdf_path),
+        'windows': len(features_df),
+        'rejected': int(mask.sum()),
+        'seconds': time.perf_counter() - start,
+        'thresholds': usable,
+        'params': _run_params(thresholds, freq_range, notch_filter, time_range, continuous, export_clean, channels, layout,
+                              window_size_sec, step_size_sec)
+    }
+    # 完了マーカーは最後に書く（途中で落ちたファイルは再実行時にやり直される）
+    with open(paths['done'], 'w', encoding='utf-8') as f: json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+def run_batch(input_dir, out_dir, thresholds, freq_range=(1.0, 50.0), notch_filter=True, time_range=(0.0, 10.0),
+              continuous=False, workers=None, max_tasks_per_child=1, max_worker_mb=None, force=False, export_clean=False,
+              channels=None, layout='wide', window_size_sec=WINDOW_SIZE_SEC, step_size_sec=STEP_SIZE_SEC):
+    """ディレクトリ内の全XDFファイルをプロセスプールで処理し、スループットの要約を返す"""
+    os.makedirs(out_dir, exist_ok=True)
+    xdf_paths = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.lower().endswith('.xdf'))
+    params = _run_params(thresholds, freq_range, notch_filter, time_range, continuous, export_clean, channels, layout,
+                         window_size_sec, step_size_sec)
+    pending = [p for p in xdf_paths if force or not _is_done(_output_paths(p, out_dir)['done'], params)]
+    logger.info("%d ファイル中 %d ファイルを処理します（%d ファイルは完了済み）", len(xdf_paths), len(pending), len(xdf_paths) - len(pending))
+
+    start = time.perf_counter()
+    results, failures = [], []
+    pool_kwargs = {'max_workers': workers, 'initializer': _limit_worker_memory, 'initargs': (max_worker_mb,)}
+    # ワーカーを一定件数ごとに作り直し、メモリの肥大化を防ぐ（Python 3.11以降）
+    if max_tasks_per_child and sys.version_info >= (3, 11): pool_kwargs['max_tasks_per_child'] = max_tasks_per_child
+    with ProcessPoolExecutor(**pool_kwargs) as pool:
+        futures = {pool.submit(process_file, p, out_dir, thresholds, freq_range, notch_filter, time_range, continuous, export_clean, channels, layout,
+                               window_size_sec, step_size_sec): p for p in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                summary = future.result()
+                results.append(summary)
+                logger.info("完了: %s (%d ウィンドウ, 除去 %d, %.1f 秒)", summary['file'], summary['windows'], summary['rejected'], summary['seconds'])
+            except Exception as e:
+                failures.append({'file': os.path.basename(path), 'error': str(e)})
+                logger.error("失敗: %s (%s)", os.path.basename(path), e)
+
+    elapsed = time.perf_counter() - start
+    total_windows = sum(r['windows'] for r in results)
+    report = {
+        'files_total': len(xdf_paths),
+        'files_skipped': len(xdf_paths) - len(pending),
+        'files_processed': len(results),
+        'files_failed': len(failures),
+        'elapsed_sec': elapsed,
+        'files_per_min': len(results) / elapsed * 60 if elapsed > 0 else 0.0,
+        'windows_per_sec': total_windows / elapsed if elapsed > 0 else 0.0,
+        'failures': failures
+    }
+    # 何も処理しなかった再実行では、前回の実測値を残すため summary.json を上書きしない
+    if pending:
+        with open(os.path.join(out_dir, 'summary.json'), 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="XDFファイルを一括でスキャンし、特徴量と除去マスクを書き出します。")
+    parser.add_argument('input_dir', help="XDFファイルのあるディレクトリ")
+    parser.add_argument('out_dir', help="出力ディレクトリ")
+    parser.add_argument('--thresholds', required=True, help="閾値設定JSON（例: {\"Fp1_amplitude\": 150, \"Fp1_delta\": 2000}）")
+    parser.add_argument('--band', type=float, nargs=2, default=(1.0, 50.0), metavar=('LOW', 'HIGH'), help="バンドパス (Hz)")
+    parser.add_argument('--no-notch', action='store_true', help="50Hzノッチフィルターを使わない")
+    parser.add_argument('--time-range', type=float, nargs=2, default=(0.0, 10.0), metavar=('START', 'END'), help="マーカーからの時間(秒)")
+    parser.add_argument('--continuous', action='store_true', help="連続スキャンモードで計算する")
+    parser.add_argument('--channels', nargs='+', default=None, help="解析するチャンネル名（既定: 全チャンネル）")
+    parser.add_argument('--layout', choices=['wide', 'long'], default='wide', help="特徴量CSVの形式（long: 1行 = 1ウィンドウ x 1チャンネル）")
+    parser.add_argument('--window', type=float, default=WINDOW_SIZE_SEC, help="ウィンドウ長(秒)")
+    parser.add_argument('--step', type=float, default=STEP_SIZE_SEC, help="ウィンドウのステップ(秒)")
+    parser.add_argument('--workers', type=int, default=None, help="並列プロセス数（既定: CPU数）")
+    parser.add_argument('--max-tasks-per-child', type=int, default=1, help="ワーカーを作り直すまでの処理ファイル数")
+    parser.add_argument('--max-worker-mb', type=float, default=None, help="ワーカー1つあたりのメモリ上限 (MB, Unixのみ)")
+    parser.add_argument('--export-clean', action='store_true', help="除去サンプルを NaN にした連続信号 (.clean.npz) も書き出す")
+    parser.add_argument('--force', action='store_true', help="同じ条件で完了済みのファイルも処理し直す")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    with open(args.thresholds, encoding='utf-8') as f: thresholds = json.load(f)
+
+    report = run_batch(args.input_dir, args.out_dir, thresholds, tuple(args.band), not args.no_notch, tuple(args.time_range),
+                       args.continuous, args.workers, args.max_tasks_per_child, args.max_worker_mb, args.force, args.export_clean,
+                       args.channels, args.layout, args.window, args.step)
+    print(f"処理 {report['files_processed']} / スキップ {report['files_skipped']} / 失敗 {report['files_failed']} ファイル, "
+          f"{report['elapsed_sec']:.1f} 秒, {report['files_per_min']:.1f} files/min, {report['windows_per_sec']:.0f} windows/s")
+    return 1 if report['files_failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
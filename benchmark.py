@@ -0,0 +1,205 @@
+"""
+パイプライン各段の処理時間とメモリを合成データで計測するベンチマーク。
+
+    python benchmark.py --sizes small medium --out bench_results.json
+    python benchmark.py --sizes small medium --baseline bench_results.json   # 基準との比較
+
+計測対象: load_xdf / apply_filters / create_epochs / calculate_features_sliding_window /
+閾値判定 / グラフ作成。synth_xdf で埋め込んだアーチファクトの検出結果も記録し、
+最適化の前後で検出結果が変わっていないかを基準ファイルと照合する。
+また、一部のウィンドウの特徴量を scipy.signal.welch と台形積分で1つずつ計算し直し、一致するかを確認する。
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scipy import signal
+try:
+    from numpy import trapezoid as trapz
+except ImportError:  # numpy < 2.0
+    from numpy import trapz
+from synth_xdf import make_synthetic_xdf
+from loader import load_xdf
+from preprocess import apply_filters, clear_filter_cache, create_epochs, create_epochs_batch, epoch_bounds
+from features import calculate_features_sliding_window, window_params, BANDS, FEATURE_NAMES
+from threshold_index import ThresholdIndex
+from rejection import rejection_sample_mask
+from utils_plot import plot_waveforms, plot_outlier_scatter, figure_payload_bytes
+
+# 計測するデータサイズ
+SIZES = {
+    'small':  {'sfreq': 250, 'duration_sec': 300, 'n_channels': 2},
+    'medium': {'sfreq': 250, 'duration_sec': 1800, 'n_channels': 8},
+    'large':  {'sfreq': 500, 'duration_sec': 3600, 'n_channels': 8},
+}
+FREQ_RANGE, NOTCH, TIME_RANGE = (1.0, 50.0), True, (0.0, 10.0)
+# 埋め込んだまばたき・筋電を検出するための固定閾値
+DETECTION_THRESHOLDS = {'Fp1_amplitude': 120.0, 'Fp1_gamma': 25.0}
+# 参照計算と照合するウィンドウ数と、許容する相対誤差
+REFERENCE_WINDOWS, REFERENCE_RTOL = 200, 1e-8
+
+def _measure(func, repeats, setup=None):
+    """tracemalloc 付きで1回（ピークメモリ）、付けずに repeats 回（最短時間）実行する"""
+    if setup: setup()
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeats):
+        if setup: setup()
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, {'seconds': min(times), 'peak_mb': peak / 1024 ** 2}
+
+def _detection_summary(filtered_eeg, features_df, recording):
+    """固定閾値での除去結果の指紋と、埋め込んだアーチファクトの検出率"""
+    mask = ThresholdIndex(features_df, list(DETECTION_THRESHOLDS)).rejection_mask(DETECTION_THRESHOLDS)
+    rejected = features_df.loc[mask, ['img_id', 'window_start_sec']].to_numpy()
+    signature = hashlib.sha1(np.round(rejected, 6).tobytes()).hexdigest()
+
+    sample_mask = rejection_sample_mask(filtered_eeg, features_df[mask], TIME_RANGE)
+    times = filtered_eeg['eeg_stream']['times']
+    covered = rejection_sample_mask(filtered_eeg, features_df, TIME_RANGE)
+    detected, total = {}, {}
+    for artifact in recording['artifacts']:
+        lo, hi = np.searchsorted(times, [artifact['start'], artifact['end']])
+        if not covered[lo:hi].any(): continue  # どのエポックにも含まれないものは対象外
+        total[artifact['kind']] = total.get(artifact['kind'], 0) + 1
+        detected[artifact['kind']] = detected.get(artifact['kind'], 0) + int(sample_mask[lo:hi].any())
+    return {
+        'rejected_windows': int(mask.sum()),
+        'signature': signature,
+        'recall': {kind: detected[kind] / total[kind] for kind in total}
+    }
+
+def _reference_features(window, sfreq):
+    # 最適化前と同じ1ウィンドウずつの計算（welch + 台形積分）
+    freqs, psd = signal.welch(window, fs=sfreq, nperseg=window.shape[-1], axis=-1)
+    powers = []
+    for low, high in BANDS.values():
+        idx = (freqs >= low) & (freqs <= high)
+        powers.append(trapz(psd[:, idx], freqs[idx], axis=-1))
+    return np.column_stack([np.ptp(window, axis=-1), *powers])
+
+def _reference_check(filtered_eeg, features_df):
+    """先頭 REFERENCE_WINDOWS 個のウィンドウについて、参照計算との最大相対誤差を求める"""
+    stream = filtered_eeg['eeg_stream']
+    sfreq = int(stream['sfreq'])
+    window_samples, _ = window_params(sfreq)
+    img_ids, _, starts, _ = epoch_bounds(filtered_eeg, TIME_RANGE)
+    rows = features_df.head(REFERENCE_WINDOWS)
+    epoch_starts = starts[pd.Index(img_ids).get_indexer(rows['img_id'])]
+    columns = [f"{ch}_{feat}" for ch in stream['ch_names'] for feat in FEATURE_NAMES]
+    expected = np.empty((len(rows), len(columns)))
+    for i, start in enumerate(epoch_starts + np.round(rows['window_start_sec'].to_numpy() * sfreq).astype(np.int64)):
+        expected[i] = _reference_features(stream['data'][:, start:start + window_samples], sfreq).ravel()
+    actual = rows[columns].to_numpy()
+    max_rel_error = float((np.abs(actual - expected) / np.maximum(np.abs(expected), 1e-12)).max()) if len(rows) else 0.0
+    return {'windows': len(rows), 'max_rel_error': max_rel_error, 'ok': max_rel_error <= REFERENCE_RTOL}
+
+def run_size(name, params, workdir, repeats):
+    """1つのデータサイズについて全段を計測する"""
+    path = os.path.join(workdir, f"bench_{name}.xdf")
+    recording = make_synthetic_xdf(path, **params)
+    results = {}
+
+    eeg_data, results['load_xdf'] = _measure(lambda: load_xdf(path), repeats)
+    n_samples = eeg_data['eeg_stream']['data'].shape[1]
+    results['load_xdf']['items'] = {'samples': n_samples, 'file_mb': os.path.getsize(path) / 1024 ** 2}
+
+    filtered_eeg, results['apply_filters'] = _measure(lambda: apply_filters(eeg_data, FREQ_RANGE, NOTCH), repeats, setup=clear_filter_cache)
+    results['apply_filters']['items'] = {'samples': n_samples}
+
+    img_ids = eeg_data['marker_index']['img_ids']
+    _, results['create_epochs'] = _measure(lambda: [create_epochs(filtered_eeg, i, TIME_RANGE) for i in img_ids], repeats)
+    results['create_epochs']['items'] = {'epochs': len(img_ids)}
+    _, results['create_epochs_batch'] = _measure(lambda: create_epochs_batch(filtered_eeg, TIME_RANGE), repeats)
+    results['create_epochs_batch']['items'] = {'epochs': len(img_ids)}
+
+    features_df, results['features'] = _measure(lambda: calculate_features_sliding_window(filtered_eeg, TIME_RANGE), repeats)
+    results['features']['items'] = {'windows': len(features_df)}
+    continuous_df, results['features_continuous'] = _measure(lambda: calculate_features_sliding_window(filtered_eeg, TIME_RANGE, continuous=True), repeats)
+    results['features_continuous']['items'] = {'windows': len(continuous_df)}
+
+    thresholds = {col: features_df[col].quantile(0.99) for col in features_df.columns if col.startswith('Fp1_')}
+    def threshold_query():
+        index = ThresholdIndex(features_df)
+        return int(index.rejection_mask(thresholds).sum())
+    _, results['threshold_query'] = _measure(threshold_query, repeats)
+    results['threshold_query']['items'] = {'windows': len(features_df)}
+
+    raw_epoch = create_epochs(eeg_data, img_ids[0], TIME_RANGE)
+    filtered_epoch = create_epochs(filtered_eeg, img_ids[0], TIME_RANGE)
+    plot_data = {'raw': raw_epoch['data'], 'filtered': filtered_epoch['data'], 'times': raw_epoch['times'], 'time_range': TIME_RANGE}
+    outliers = features_df[features_df['img_id'] == img_ids[0]].head(20).rename(columns={'window_start_sec': 'second', 'window_end_sec': 'second_end'})
+    waveform, results['plot_waveforms'] = _measure(lambda: plot_waveforms(plot_data, "並べて", outliers), repeats)
+    results['plot_waveforms']['items'] = {'payload_kb': figure_payload_bytes(waveform) / 1024}
+    scatter, results['plot_outlier_scatter'] = _measure(lambda: plot_outlier_scatter(features_df, 'Fp1_delta', 'Fp1_amplitude', 'img_id'), repeats)
+    results['plot_outlier_scatter']['items'] = {'points': len(features_df), 'payload_kb': figure_payload_bytes(scatter) / 1024}
+
+    detection = _detection_summary(filtered_eeg, features_df, recording)
+    detection['reference'] = _reference_check(filtered_eeg, features_df)
+    return results, detection
+
+def compare(current, baseline, tolerance=1.3, min_seconds=0.01):
+    """基準より tolerance 倍以上遅くなった段と、検出結果が変わったサイズを列挙する"""
+    problems = []
+    for size, stages in current['results'].items():
+        for stage, stats in stages.items():
+            base = baseline.get('results', {}).get(size, {}).get(stage)
+            if base is None: continue
+            ratio = stats['seconds'] / base['seconds'] if base['seconds'] > 0 else 1.0
+            if ratio > tolerance and stats['seconds'] > min_seconds:
+                problems.append(f"{size}/{stage}: {base['seconds']:.3f}s -> {stats['seconds']:.3f}s (x{ratio:.2f})")
+        base_detection = baseline.get('detection', {}).get(size)
+        if base_detection and base_detection['signature'] != current['detection'][size]['signature']:
+            problems.append(f"{size}: 検出結果が変化 ({base_detection['rejected_windows']} -> {current['detection'][size]['rejected_windows']} ウィンドウ)")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成XDFでパイプライン各段を計測します。")
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(SIZES))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--out', default='bench_results.json', help="結果を書き出すJSON")
+    parser.add_argument('--baseline', help="比較する基準の結果JSON")
+    parser.add_argument('--tolerance', type=float, default=1.3, help="許容する処理時間の倍率")
+    parser.add_argument('--workdir', default=None, help="合成XDFの置き場所（既定: 一時ディレクトリ）")
+    args = parser.parse_args(argv)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__, 'platform': platform.platform()},
+        'results': {}, 'detection': {}
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        for size in args.sizes:
+            report['results'][size], report['detection'][size] = run_size(size, SIZES[size], workdir, args.repeats)
+            for stage, stats in report['results'][size].items():
+                print(f"{size:>6} {stage:<22} {stats['seconds'] * 1000:9.1f} ms  peak {stats['peak_mb']:8.1f} MB  {stats.get('items', {})}")
+            print(f"{size:>6} detection {report['detection'][size]}")
+
+    with open(args.out, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    mismatched = [size for size, detection in report['detection'].items() if not detection['reference']['ok']]
+    for size in mismatched: print(f"NG {size}: 参照計算（welch + 台形積分）と特徴量が一致しません {report['detection'][size]['reference']}")
+    if mismatched: return 1
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f: baseline = json.load(f)
+        problems = compare(report, baseline, args.tolerance)
+        for problem in problems: print(f"NG {problem}")
+        if problems: return 1
+        print("基準との比較: 問題なし")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+from loader import CACHE_DIR
+from features import BANDS, WINDOW_SIZE_SEC, STEP_SIZE_SEC
+
+# 特徴量キャッシュの置き場所と容量上限（超えたら最終利用が古いものから削除）
+STORE_DIR = os.path.join(CACHE_DIR, 'features')
+STORE_MAX_BYTES = int(float(os.environ.get('EEGCHECK_FEATURE_STORE_MAX_MB', 1024)) * 1024 ** 2)
+STORE_FORMAT_VERSION = 3
+
+def make_key(recording_id, freq_range, notch_filter, time_range, continuous=False,
+             window_size_sec=WINDOW_SIZE_SEC, step_size_sec=STEP_SIZE_SEC, bands=BANDS, channels=None, layout='wide'):
+    """XDFの内容ハッシュとスキャン条件からキャッシュキーとその元のパラメータを作る（記録IDが無ければ None）"""
+    if recording_id is None: return None, None
+    params = {
+        'version': STORE_FORMAT_VERSION,
+        'recording_id': recording_id,
+        'freq_range': [float(v) for v in freq_range],
+        'notch_filter': bool(notch_filter),
+        'time_range': [float(v) for v in time_range],
+        'continuous': bool(continuous),
+        'window_size_sec': float(window_size_sec),
+        'step_size_sec': float(step_size_sec),
+        'bands': {name: [float(v) for v in band] for name, band in bands.items()},
+        'channels': None if channels is None else [str(ch) for ch in channels],
+        'layout': layout
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest(), params
+
+def _paths(key, store_dir):
+    return os.path.join(store_dir, f"{key}.npz"), os.path.join(store_dir, f"{key}.json")
+
+def load_features(key, store_dir=STORE_DIR):
+    """キャッシュにあれば特徴量DataFrameを返す（無ければ None）"""
+    if key is None: return None
+    data_path, meta_path = _paths(key, store_dir)
+    try:
+        with open(meta_path, encoding='utf-8') as f: meta = json.load(f)
+        with np.load(data_path, allow_pickle=False) as npz:
+            categorical = set(meta.get('categorical', []))
+            df = pd.DataFrame({col: pd.Categorical.from_codes(npz[f"c{i}"], npz[f"k{i}"]) if col in categorical else npz[f"c{i}"]
+                               for i, col in enumerate(meta['columns'])})
+        # 最終利用時刻を更新（LRU削除の基準）。読み込み直後に別セッションが削除していればキャッシュ無しとして扱う
+        now = time.time()
+        os.utime(meta_path, (now, now))
+    except (OSError, ValueError, KeyError):
+        return None
+    return df
+
+def save_features(key, df, params=None, store_dir=STORE_DIR, max_bytes=STORE_MAX_BYTES):
+    """特徴量DataFrameをNPZで保存し、容量上限を超えた分を古い順に削除する"""
+    if key is None or df.empty: return
+    os.makedirs(store_dir, exist_ok=True)
+    data_path, meta_path = _paths(key, store_dir)
+    # 同じプロセスの別セッション（スレッド）と一時ファイルがぶつからないよう、スレッドIDも名前に含める
+    tmp_suffix = f"{os.getpid()}-{threading.get_ident()}.tmp"
+    tmp_data = f"{data_path}.{tmp_suffix}.npz"
+    # カテゴリ列（long 形式の channel など）はコードとカテゴリに分けて保存する（allow_pickle=False で読めるように）
+    arrays, categorical = {}, []
+    for i, col in enumerate(df.columns):
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            arrays[f"c{i}"] = df[col].cat.codes.to_numpy()
+            arrays[f"k{i}"] = df[col].cat.categories.to_numpy().astype(str)
+            categorical.append(col)
+        else:
+            arrays[f"c{i}"] = df[col].to_numpy()
+    np.savez(tmp_data, **arrays)
+    os.replace(tmp_data, data_path)
+
+    meta = {'columns': list(df.columns), 'categorical': categorical, 'rows': len(df), 'created': time.time(), 'params': params}
+    tmp_meta = f"{meta_path}.{tmp_suffix}"
+    with open(tmp_meta, 'w', encoding='utf-8') as f: json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_meta, meta_path)
+    _evict(store_dir, max_bytes)
+
+def list_entries(store_dir=STORE_DIR):
+    """保存済みエントリの一覧（最終利用が新しい順）"""
+    if not os.path.isdir(store_dir): return pd.DataFrame(columns=['key', 'rows', 'size_mb', 'last_used', 'params'])
+    entries = []
+    for name in os.listdir(store_dir):
+        if not name.endswith('.json'): continue
+        key = name[:-len('.json')]
+        data_path, meta_path = _paths(key, store_dir)
+        try:
+            with open(meta_path, encoding='utf-8') as f: meta = json.load(f)
+            size = os.path.getsize(data_path) + os.path.getsize(meta_path)
+            last_used = os.path.getmtime(meta_path)
+        except (OSError, ValueError):
+            continue
+        entries.append({'key': key, 'rows': meta.get('rows'), 'size_mb': size / 1024 ** 2,
+                        'last_used': pd.Timestamp(last_used, unit='s'), 'params': meta.get('params')})
+    df = pd.DataFrame(entries, columns=['key', 'rows', 'size_mb', 'last_used', 'params'])
+    return df.sort_values('last_used', ascending=False, ignore_index=True)
+
+def purge(key=None, store_dir=STORE_DIR):
+    """指定したエントリ（None なら全エントリ）を削除し、削除件数を返す"""
+    keys = list_entries(store_dir)['key'].tolist() if key is None else [key]
+    for k in keys:
+        for path in _paths(k, store_dir):
+            try: os.remove(path)
+            except FileNotFoundError: pass
+    return len(keys)
+
+def _evict(store_dir, max_bytes):
+    entries = list_entries(store_dir)
+    total = entries['size_mb'].sum() * 1024 ** 2
+    # 最終利用が古いものから削除（直前に保存したものは残す）
+    for key, size_mb in zip(entries['key'].tolist()[:0:-1], entries['size_mb'].tolist()[:0:-1]):
+        if total <= max_bytes: break
+        purge(key, store_dir)
+        total -= size_mb * 1024 ** 2
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from threshold_index import ThresholdIndex
+from features import FEATURE_NAMES
+
+# 評価データのうち色分けに使わない列
+EVAL_EXCLUDE_COLUMNS = ['sid', 'img_id', 'time']
+
+def compact_features(features_df):
+    """
+    特徴量列とウィンドウの時刻を float32、img_id を int32 にした表を返す。
+    時刻はエポック先頭からの秒なので、float32 でもサンプル位置に丸めたときに誤差は出ない。
+    """
+    float_columns = ['window_start_sec', 'window_end_sec', *FEATURE_NAMES]
+    dtypes = {col: np.float32 for col in features_df.columns if col in float_columns or col.rsplit('_', 1)[-1] in FEATURE_NAMES}
+    if 'img_id' in features_df.columns and features_df['img_id'].abs().max() < 2 ** 31: dtypes['img_id'] = np.int32
+    return features_df.astype(dtypes)
+
+class FeatureTable:
+    """
+    スキャン結果（long 形式）を対話操作向けに1回だけ整えたもの。
+    表は compact_features() した1つだけを持ち、チャンネル・除去対象・試行ごとの部分集合は行番号の配列で表す。
+    評価データは img_id→行番号の対応を1回だけ作って引き、結合した表は描画に必要な列だけを作る。
+    """
+
+    def __init__(self, features_df, eval_data=None):
+        # チャンネルごとの行が連続するように並べ替えておく（部分集合の取り出しがメモリ上で連続になる）
+        codes = features_df['channel'].cat.codes.to_numpy()
+        order = np.argsort(codes, kind='stable')
+        self.df = compact_features(features_df).take(order).reset_index(drop=True)
+        self.channels = list(self.df['channel'].cat.categories)
+        bounds = np.searchsorted(codes[order], np.arange(len(self.channels) + 1))
+        self._channel_rows = {ch: np.arange(bounds[i], bounds[i + 1], dtype=np.int32) for i, ch in enumerate(self.channels)}
+        self._indexes = {}
+        self._frame_cache = (None, None)
+        self.eval_data, self.eval_columns, self._eval_rows, self._eval_first = None, [], None, None
+        self.attach_eval(eval_data)
+
+    def attach_eval(self, eval_data):
+        """評価データの行番号を img_id から引いておく（同じ評価データなら何もしない）"""
+        if eval_data is self.eval_data: return
+        self.eval_data, self._frame_cache = eval_data, (None, None)
+        if eval_data is None:
+            self.eval_columns, self._eval_rows, self._eval_first = [], None, None
+            return
+        # img_id が重複している場合は最初の行を使う
+        first = eval_data.drop_duplicates('img_id').reset_index(drop=True)
+        self.eval_columns = [c for c in eval_data.columns if c not in EVAL_EXCLUDE_COLUMNS]
+        self._eval_first = first
+        self._eval_rows = pd.Index(first['img_id']).get_indexer(self.df['img_id'].to_numpy()).astype(np.int32)
+
+    def channel_rows(self, ch):
+        return self._channel_rows[ch]
+
+    def threshold_index(self, ch):
+        """チャンネルごとの閾値索引（初回だけ作る）。マスクは channel_rows(ch) の並びに対応する"""
+        if ch not in self._indexes:
+            self._indexes[ch] = ThresholdIndex(self.df.iloc[self._channel_rows[ch]], FEATURE_NAMES)
+        return self._indexes[ch]
+
+    def rows_for_trial(self, rows, img_id):
+        """行番号のうち、指定した画像IDのものだけ"""
+        return rows[self.df['img_id'].to_numpy()[rows] == img_id]
+
+    def frame(self, rows, columns=None, eval_columns=()):
+        """
+        行番号の部分集合を DataFrame にする（描画・書き出し用）。
+        columns で特徴量側の列を絞り、eval_columns の評価データ列を img_id で対応する値で付け加える（無ければ NaN）。
+        """
+        columns = self.df.columns if columns is None else dict.fromkeys(['img_id', 'window_start_sec', 'window_end_sec', 'channel', *columns])
+        data = {}
+        for col in columns:
+            series = self.df[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                data[col] = pd.Categorical.from_codes(series.cat.codes.to_numpy()[rows], dtype=series.dtype)
+            else:
+                data[col] = series.to_numpy()[rows]
+        if eval_columns:
+            eval_rows = self._eval_rows[rows]
+            all_found = bool((eval_rows >= 0).all())
+            for col in eval_columns:
+                # 行番号 -1（評価データに無い img_id）は reindex で NaN にする
+                data[col] = self._eval_first[col].to_numpy()[eval_rows] if all_found else self._eval_first[col].reindex(eval_rows).to_numpy()
+        return pd.DataFrame(data)
+
+    def channel_frame(self, ch, columns, eval_columns=()):
+        """
+        1チャンネル分の frame()。閾値を動かしただけの再実行では同じ表を使い回すよう、直近の1つだけ覚えておく。
+        """
+        key = (ch, tuple(columns), tuple(eval_columns))
+        if self._frame_cache[0] != key: self._frame_cache = (key, self.frame(self._channel_rows[ch], columns, eval_columns))
+        return self._frame_cache[1]
+
+    def memory_mb(self):
+        """表と行番号・閾値索引が使うメモリ(MB)"""
+        total = self.df.memory_usage(deep=True).sum() + sum(rows.nbytes for rows in self._channel_rows.values())
+        if self._eval_rows is not None: total += self._eval_rows.nbytes
+        total += sum(index.nbytes for index in self._indexes.values())
+        if self._frame_cache[1] is not None: total += self._frame_cache[1].memory_usage(deep=True).sum()
+        return total / 1024 ** 2
@@ -1,70 +1,318 @@
+import logging
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 from scipy import signal
-from numpy import trapz
-import streamlit as st
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+from instrumentation import stage, timed
 
-def calculate_psd(data, sfreq):
-    nperseg = len(data)
-    return signal.welch(data, fs=sfreq, nperseg=nperseg)
+logger = logging.getLogger(__name__)
 
-def bandpower(freqs, psd, band):
-    idx_band = np.logical_and(freqs >= band[0], freqs <= band[1])
-    return trapz(psd[idx_band], freqs[idx_band])
+WINDOW_SIZE_SEC = 0.5
+STEP_SIZE_SEC = 0.1
+# calculate_features_multiresolution() で既定でまとめて計算するウィンドウ長
+MULTI_WINDOW_SIZES_SEC = (0.25, 0.5, 1.0)
 
-def calculate_features_sliding_window(filtered_eeg_data, time_range):
+# 全てのバンドを定義
+BANDS = {
+    'delta': [1, 4],
+    'theta': [4, 7],
+    'alpha': [8, 13],
+    'beta':  [13, 30],
+    'gamma': [30, 50]
+}
+FEATURE_NAMES = ['amplitude'] + list(BANDS)
+
+def band_weights(freqs, bands=BANDS):
+    """各バンド内の周波数ビンでの台形積分（両端を含む）を行列積1回で行うための重み (n_bands, n_freqs)"""
+    weights = np.zeros((len(bands), len(freqs)))
+    for i, (low, high) in enumerate(bands.values()):
+        idx = np.flatnonzero((freqs >= low) & (freqs <= high))
+        if len(idx) < 2: continue
+        half_df = np.diff(freqs[idx]) / 2
+        weights[i, idx[:-1]] += half_df
+        weights[i, idx[1:]] += half_df
+    return weights
+
+@lru_cache(maxsize=16)
+def _spectral_projection(window_samples, sfreq):
+    """
+    ウィンドウ全体を1セグメントとする welch（hann窓・平均除去・片側密度の periodogram）とバンド積分を行列積2回で行うための係数。
+    benchmark.py で scipy.signal.welch と台形積分による計算と一致することを確認している。
+    バンドに使われる周波数ビンだけの DFT 基底 (window_samples, 2K) と、ビン→バンドの重み (n_bands, K) を返す。
+    """
+    freqs = np.fft.rfftfreq(window_samples, 1 / sfreq)
+    weights = band_weights(freqs)
+    bins = np.flatnonzero(weights.any(axis=0))
+    window = signal.get_window('hann', window_samples)
+    dft = window[:, None] * np.exp(-2j * np.pi * np.outer(np.arange(window_samples), bins) / window_samples)
+    # 平均除去（detrend='constant'）は線形なので基底に含めてしまう
+    dft -= dft.sum(axis=0, keepdims=True) / window_samples
+    basis = np.concatenate([dft.real, dft.imag], axis=1)
+    onesided = np.where((bins == 0) | ((window_samples % 2 == 0) & (bins == window_samples // 2)), 1.0, 2.0)
+    bin_weights = weights[:, bins] * onesided / (sfreq * (window ** 2).sum())
+    basis.flags.writeable = False
+    bin_weights.flags.writeable = False
+    return basis, bin_weights
+
+def window_params(sfreq, window_size_sec=WINDOW_SIZE_SEC, step_size_sec=STEP_SIZE_SEC):
+    """
+    ウィンドウ長とステップ（秒）をサンプル数に直す（従来どおり切り捨て。0.1 * 250 = 25.000000000000004 のような
+    浮動小数点の誤差で1サンプル減らないよう、わずかに上乗せしてから切り捨てる）。短すぎる場合は ValueError
+    """
+    window_samples, step_samples = int(window_size_sec * sfreq + 1e-9), int(step_size_sec * sfreq + 1e-9)
+    if window_samples < 2: raise ValueError(f"ウィンドウ長 {window_size_sec} 秒は短すぎます（{sfreq} Hz で2サンプル未満）。")
+    if step_samples < 1: raise ValueError(f"ステップ {step_size_sec} 秒は短すぎます（{sfreq} Hz で1サンプル未満）。")
+    return window_samples, step_samples
+
+def sliding_windows(data, window_samples, step_samples):
+    """(n_ch, n_samples) の信号から (n_ch, n_windows, window_samples) のストライドビューを作る（コピーなし）"""
+    return np.lib.stride_tricks.sliding_window_view(data, window_samples, axis=-1)[..., ::step_samples, :]
+
+# 1回の行列積で扱う要素数の目安（チャンネル数が多いときはウィンドウ数を減らす）
+_CHUNK_ELEMENTS = 2 ** 22
+
+def _chunk_size(n_ch, window_samples):
+    return max(1, _CHUNK_ELEMENTS // max(1, n_ch * window_samples))
+
+# window / step がこれ以上（重なりが大きい）なら、振幅をスライディング最大・最小で求める
+# （それより重なりが小さいと、ストライドビューの ptp の方が速い）
+_SLIDING_EXTREMA_RATIO = 32
+
+def sliding_amplitude(data, window_samples, step_samples, first, count):
+    """
+    first 番目から count 個のウィンドウの振幅（最大 - 最小）を (n_ch, count) で返す。
+    スライディング最大・最小フィルターで各サンプル O(1) なので、計算量はウィンドウ長によらない。
+    """
+    segment = data[:, first * step_samples:(first + count - 1) * step_samples + window_samples]
+    # origin でフィルターの窓を「そのサンプルから始まる window_samples 点」に合わせる
+    origin = -(window_samples // 2)
+    high = maximum_filter1d(segment, window_samples, axis=-1, origin=origin)
+    low = minimum_filter1d(segment, window_samples, axis=-1, origin=origin)
+    last = (count - 1) * step_samples + 1
+    return high[:, :last:step_samples] - low[:, :last:step_samples]
+
+def _window_features(windows, sfreq, out, amplitude=None):
+    """
+    (n_ch, n, window_samples) のウィンドウ群から (n, n_ch, n_features) の特徴量を全チャンネル一括で out に書き込む。
+    amplitude に (n_ch, n) の振幅を渡すと、ptp を計算せずにそれを使う。
+    """
+    basis, bin_weights = _spectral_projection(windows.shape[-1], sfreq)
+    n_bins = bin_weights.shape[1]
+    spectrum = windows @ basis
+    psd = spectrum[..., :n_bins] ** 2 + spectrum[..., n_bins:] ** 2
+    out[..., 0] = (np.ptp(windows, axis=-1) if amplitude is None else amplitude).T
+    out[..., 1:] = (psd @ bin_weights.T).transpose(1, 0, 2)
+
+def compute_window_features(data, sfreq, window_samples, step_samples, out=None, chunk_windows=None):
+    """
+    全ウィンドウ・全チャンネルの特徴量をまとめて計算する。
+    戻り値は (n_windows, n_ch, len(FEATURE_NAMES)) の配列（out を渡すとそこへ書き込む）。
+    """
+    windows = sliding_windows(data, window_samples, step_samples)
+    n_ch, n_windows = windows.shape[:2]
+    if out is None: out = np.empty((n_windows, n_ch, len(FEATURE_NAMES)))
+    chunk_windows = chunk_windows or _chunk_size(n_ch, window_samples)
+    sliding = window_samples >= _SLIDING_EXTREMA_RATIO * step_samples
+
+    # 巨大なセッションでもメモリが膨らまないよう、ウィンドウ軸で分割して計算
+    for start in range(0, n_windows, chunk_windows):
+        stop = min(start + chunk_windows, n_windows)
+        amplitude = sliding_amplitude(data, window_samples, step_samples, start, stop - start) if sliding else None
+        _window_features(windows[:, start:stop], sfreq, out[start:stop], amplitude)
+    return out
+
+@timed('features.frame')
+def features_to_frame(img_ids, start_samples, values, sfreq, window_samples, ch_names, layout='wide'):
+    """
+    列指向の配列から特徴量DataFrameを1回で組み立てる。
+    layout='wide' はチャンネル×特徴量ごとの列（Fp1_amplitude, ...）、
+    layout='long' は1行 = 1ウィンドウ×1チャンネルで channel 列（カテゴリ型）と特徴量列だけを持つ。
+    """
+    if layout == 'long':
+        n_windows, n_ch = values.shape[:2]
+        flat = values.reshape(n_windows * n_ch, len(FEATURE_NAMES))
+        columns = {
+            'img_id': np.repeat(img_ids, n_ch),
+            'window_start_sec': np.repeat(start_samples / sfreq, n_ch),
+            'window_end_sec': np.repeat((start_samples + window_samples) / sfreq, n_ch),
+            'channel': pd.Categorical.from_codes(np.tile(np.arange(n_ch), n_windows), categories=list(ch_names))
+        }
+        for feat_idx, feat_name in enumerate(FEATURE_NAMES):
+            columns[feat_name] = flat[:, feat_idx]
+        return pd.DataFrame(columns)
+
+    columns = {
+        'img_id': img_ids,
+        'window_start_sec': start_samples / sfreq,
+        'window_end_sec': (start_samples + window_samples) / sfreq
+    }
+    for ch_idx, ch_name in enumerate(ch_names):
+        for feat_idx, feat_name in enumerate(FEATURE_NAMES):
+            columns[f'{ch_name}_{feat_name}'] = values[:, ch_idx, feat_idx]
+    return pd.DataFrame(columns)
+
+def _features_continuous(filtered_eeg_data, time_range, sfreq, window_samples, step_samples, progress=None):
     """
-    スライディングウィンドウ法で全バンドの特徴量を計算する
+    記録全体に共通のステップ格子を1回だけ走らせ、各ウィンドウを含む全エポックへ割り当てる。
+    window_start_sec はエポック先頭からの相対時刻（格子がエポック先頭とずれる分、最大1ステップ未満の差が出る）。
     """
-    from preprocess import create_epochs
+    from preprocess import epoch_bounds
 
-    all_features = []
+    data = filtered_eeg_data['eeg_stream']['data']
+    img_id_index, _, starts, ends = epoch_bounds(filtered_eeg_data, time_range)
+    windows = sliding_windows(data, window_samples, step_samples)
+    n_grid = windows.shape[1]
+
+    # 各エポックに完全に収まる格子ウィンドウの範囲 [k_lo, k_hi]
+    k_lo = -(-starts // step_samples)
+    k_hi = np.minimum((ends - window_samples) // step_samples, n_grid - 1)
+    counts = np.maximum(k_hi - k_lo + 1, 0)
+    total_windows = int(counts.sum())
+    if total_windows == 0: return None
+
+    # どれか1つのエポックに属する格子ウィンドウだけを1回ずつ計算する
+    coverage = np.zeros(n_grid + 1, dtype=np.int64)
+    has_windows = counts > 0
+    np.add.at(coverage, k_lo[has_windows], 1)
+    np.add.at(coverage, k_hi[has_windows] + 1, -1)
+    needed = np.flatnonzero(np.cumsum(coverage[:-1]) > 0)
+    computed = np.empty((len(needed), data.shape[0], len(FEATURE_NAMES)))
+    chunk_windows = _chunk_size(data.shape[0], window_samples)
+    sliding = window_samples >= _SLIDING_EXTREMA_RATIO * step_samples
+    for start in range(0, len(needed), chunk_windows):
+        idx = needed[start:start + chunk_windows]
+        amplitude = None
+        if sliding:
+            amplitude = sliding_amplitude(data, window_samples, step_samples, idx[0], idx[-1] - idx[0] + 1)[:, idx - idx[0]]
+        _window_features(windows[:, idx], sfreq, computed[start:start + len(idx)], amplitude)
+        if progress: progress(start + len(idx), len(needed), None)
+
+    # エポック→格子ウィンドウの対応表（重なる区間は同じ計算結果を共有する）
+    epoch_of_row = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    k_rows = k_lo[epoch_of_row] + np.arange(total_windows) - offsets[epoch_of_row]
+    start_samples = k_rows * step_samples - starts[epoch_of_row]
+    return img_id_index[epoch_of_row], start_samples, computed[np.searchsorted(needed, k_rows)]
+
+def _features_epochs(filtered_eeg_data, time_range, sfreq, window_sizes, step_samples, layout, progress=None):
+    """
+    エポックごとにスライディングウィンドウの特徴量を計算し、{window_samples: DataFrame} を返す。
+    複数のウィンドウ長を渡すと、各エポックの信号を1回だけ読み出して全てのウィンドウ長で使い回す。
+    """
+    from preprocess import epoch_bounds
+
+    eeg_stream = filtered_eeg_data['eeg_stream']
+    ch_names = eeg_stream['ch_names']
+    img_id_index, _, starts, ends = epoch_bounds(filtered_eeg_data, time_range)
+    lengths = ends - starts
+
+    # 先にウィンドウ長ごとの全エポックのウィンドウ数を確定させ、結果の配列を一括で確保する
+    plans = {}
+    for window_samples in window_sizes:
+        num_windows = np.where(lengths >= window_samples, (lengths - window_samples) // step_samples + 1, 0)
+        total_windows = int(num_windows.sum())
+        if total_windows == 0: continue
+        offsets = np.cumsum(num_windows) - num_windows
+        epoch_of_row = np.repeat(np.arange(len(num_windows)), num_windows)
+        plans[window_samples] = {
+            'num_windows': num_windows, 'offsets': offsets,
+            'img_ids': img_id_index[epoch_of_row],
+            'start_samples': (np.arange(total_windows) - offsets[epoch_of_row]) * step_samples,
+            'values': np.empty((total_windows, len(ch_names), len(FEATURE_NAMES)))
+        }
+    if not plans: return {}
+
+    def frames(end=None):
+        result = {}
+        for w, p in plans.items():
+            rows = slice(None, end(p) if end else None)
+            result[w] = features_to_frame(p['img_ids'][rows], p['start_samples'][rows], p['values'][rows], sfreq, w, ch_names, layout)
+        return result
+
+    data = eeg_stream['data']
+    epochs_with_windows = np.flatnonzero(np.any([p['num_windows'] > 0 for p in plans.values()], axis=0))
+    total_windows = sum(len(p['img_ids']) for p in plans.values())
+    with stage('features.compute', epochs=len(epochs_with_windows), windows=total_windows, channels=len(ch_names), resolutions=len(plans)):
+        for done, row in enumerate(epochs_with_windows, 1):
+            segment = data[:, starts[row]:ends[row]]
+            # メモリマップ上の信号は、ウィンドウ長が複数なら一度だけメモリに読み込んで使い回す
+            if len(plans) > 1: segment = np.array(segment)
+            for window_samples, p in plans.items():
+                if p['num_windows'][row] == 0: continue
+                rows = slice(p['offsets'][row], p['offsets'][row] + p['num_windows'][row])
+                compute_window_features(segment, sfreq, window_samples, step_samples, out=p['values'][rows])
+            if progress:
+                # 計算済みの行は以降書き換えないので、途中結果は必要になったときに別スレッドから組み立ててよい
+                partial = lambda row=row: frames(lambda p: p['offsets'][row] + p['num_windows'][row])
+                progress(done, len(epochs_with_windows), partial)
+
+    return frames()
+
+def calculate_features_sliding_window(filtered_eeg_data, time_range, continuous=False, layout='wide', progress=None,
+                                      window_size_sec=WINDOW_SIZE_SEC, step_size_sec=STEP_SIZE_SEC):
+    """
+    スライディングウィンドウ法で全バンドの特徴量を計算する。
+    continuous=True の場合は連続記録全体を1回だけスキャンし、重なり合うエポック間で計算結果を共有する。
+    layout は features_to_frame() を参照（チャンネル数が多い場合は 'long' を推奨）。
+    progress(完了数, 全体数, partial) を渡すと試行ごと（連続スキャンでは計算ブロックごと）に呼ぶ。
+    partial() はその時点までに計算済みの行のDataFrameを返す（連続スキャンでは None）。中断したいときは progress から例外を送出する。
+    """
     eeg_stream = filtered_eeg_data['eeg_stream']
     sfreq = int(eeg_stream['sfreq'])
+    ch_names = eeg_stream['ch_names']
+    window_samples, step_samples = window_params(sfreq, window_size_sec, step_size_sec)
 
-    window_size_sec = 0.5
-    step_size_sec = 0.1
-    window_samples = int(window_size_sec * sfreq)
-    step_samples = int(step_size_sec * sfreq)
-
-    # 全てのバンドを定義
-    bands = {
-        'delta': [1, 4],
-        'theta': [4, 7],
-        'alpha': [8, 13],
-        'beta':  [13, 30],
-        'gamma': [30, 50]
-    }
+    if continuous:
+        with stage('features.compute', channels=len(ch_names), continuous=True) as s:
+            result = _features_continuous(filtered_eeg_data, time_range, sfreq, window_samples, step_samples, progress)
+            s.set(windows=0 if result is None else len(result[0]))
+        if result is None:
+            logger.warning("特徴量を計算できるデータがありませんでした。")
+            return pd.DataFrame()
+        return features_to_frame(*result, sfreq, window_samples, ch_names, layout)
 
-    for marker_val in filtered_eeg_data['markers']['marker_value'].unique():
-        epoch = create_epochs(filtered_eeg_data, marker_val, time_range)
-        if epoch is None or epoch['data'].shape[1] < window_samples: continue
-        
-        data = epoch['data']
-        num_windows = (data.shape[1] - window_samples) // step_samples + 1
-
-        for i in range(num_windows):
-            start_idx = i * step_samples
-            end_idx = start_idx + window_samples
-            window_data = data[:, start_idx:end_idx]
-            
-            window_start_sec = start_idx / sfreq
-
-            features = {'img_id': marker_val, 'window_start_sec': window_start_sec, 'window_end_sec': end_idx / sfreq}
-            
-            for ch_idx, ch_name in enumerate(['Fp1', 'Fp2']):
-                ch_data = window_data[ch_idx]
-                features[f'{ch_name}_amplitude'] = np.ptp(ch_data)
-                
-                freqs, psd = calculate_psd(ch_data, sfreq)
-                # 全てのバンドパワーを計算
-                for band_name, band_range in bands.items():
-                    features[f'{ch_name}_{band_name}'] = bandpower(freqs, psd, band_range)
-            
-            all_features.append(features)
-            
-    if not all_features: 
-        st.warning("特徴量を計算できるデータがありませんでした。")
+    single = progress and (lambda done, total, partial: progress(done, total, lambda: partial()[window_samples]))
+    frames = _features_epochs(filtered_eeg_data, time_range, sfreq, [window_samples], step_samples, layout, single)
+    if not frames:
+        logger.warning("特徴量を計算できるデータがありませんでした。")
         return pd.DataFrame()
-        
-    return pd.DataFrame(all_features)
+    return frames[window_samples]
+
+def calculate_features_multiresolution(filtered_eeg_data, time_range, window_sizes=MULTI_WINDOW_SIZES_SEC, step_size_sec=STEP_SIZE_SEC,
+                                       continuous=False, layout='wide', progress=None):
+    """
+    複数のウィンドウ長の特徴量をまとめて計算し、{ウィンドウ長(秒): DataFrame} を返す。
+    各ウィンドウ長の結果は calculate_features_sliding_window() を個別に呼んだ場合と同じで、
+    エポックの信号の読み出しとエポック境界の計算を全ウィンドウ長で共有する。
+    progress の partial() は同じ形の辞書を返す。continuous=True ではウィンドウ長ごとに記録全体を走査する。
+    """
+    eeg_stream = filtered_eeg_data['eeg_stream']
+    sfreq = int(eeg_stream['sfreq'])
+    samples = {size: window_params(sfreq, size, step_size_sec) for size in window_sizes}
+    step_samples = next(iter(samples.values()))[1]
+
+    if continuous:
+        return {size: calculate_features_sliding_window(filtered_eeg_data, time_range, True, layout, progress, size, step_size_sec)
+                for size in window_sizes}
+
+    # 秒→サンプル数の丸めで同じ長さになったウィンドウ長は1回だけ計算する
+    by_samples = lambda frames: {size: frames.get(w, pd.DataFrame()) for size, (w, _) in samples.items()}
+    wrapped = progress and (lambda done, total, partial: progress(done, total, lambda: by_samples(partial())))
+    frames = _features_epochs(filtered_eeg_data, time_range, sfreq, list(dict.fromkeys(w for w, _ in samples.values())), step_samples, layout, wrapped)
+    if not frames: logger.warning("特徴量を計算できるデータがありませんでした。")
+    return by_samples(frames)
+
+def rejection_mask(features_df, thresholds):
+    """
+    いずれか1つでも閾値以上の特徴量を持つ行を True とするマスク。
+    long 形式では 'amplitude' のような特徴量名は全チャンネルに、'Fp1_amplitude' はそのチャンネルの行だけに適用する。
+    """
+    mask = np.zeros(len(features_df), dtype=bool)
+    for key, val in thresholds.items():
+        if key in features_df.columns:
+            mask |= features_df[key].to_numpy() >= val
+        else:
+            ch_name, feat_name = key.rsplit('_', 1)
+            mask |= (features_df['channel'].to_numpy() == ch_name) & (features_df[feat_name].to_numpy() >= val)
+    return mask
@@ -0,0 +1,202 @@
+"""
+パイプライン各段の計測（経過時間・CPU時間・ピークメモリ・処理件数）とサンプリングプロファイラ。
+
+    with instrumentation.run('scan', recording_id=...):
+        with instrumentation.stage('features.compute', windows=n) as s:
+            ...
+            s.set(rows=len(df))
+
+run() の終了時に、中の stage() の内訳を1つのJSONレコードとしてログ（logger 'instrumentation'）に出す。
+環境変数 EEGCHECK_INSTRUMENT_LOG にファイルパスを指定すると、同じレコードをJSON Lines形式で追記する。
+計測は既定で無効（EEGCHECK_INSTRUMENT=1 または enable() で有効化、=time ならメモリは測らない）で、
+無効の間の stage() は何もしない。
+メモリは tracemalloc で測る。ピークの記録はプロセスで1つなので、別スレッドの stage と
+実行期間が重なった stage のピークは正しく測れず、peak_mb を None（peak_shared=True）にする。
+"""
+import collections
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger('instrumentation')
+
+_enabled = False
+_log_path = os.environ.get('EEGCHECK_INSTRUMENT_LOG')
+_local = threading.local()
+_last_runs = {}
+_last_runs_lock = threading.Lock()
+# 全スレッドで実行中の stage（tracemalloc のピークを reset してよいかの判定に使う）
+_open_stages = []
+_open_lock = threading.Lock()
+
+def enable(flag=True, trace_memory=True):
+    """計測の有効・無効を切り替える（プロセス全体に効く）"""
+    global _enabled
+    _enabled = bool(flag)
+    if _enabled and trace_memory and not tracemalloc.is_tracing(): tracemalloc.start()
+    if not _enabled and tracemalloc.is_tracing(): tracemalloc.stop()
+
+if os.environ.get('EEGCHECK_INSTRUMENT', '') not in ('', '0'):
+    enable(trace_memory=os.environ['EEGCHECK_INSTRUMENT'] != 'time')
+
+def is_enabled():
+    return _enabled
+
+def last_runs():
+    """run 名ごとの直近のレコード（プロセス内で共有）"""
+    with _last_runs_lock:
+        return dict(_last_runs)
+
+class _NullStage:
+    """計測無効時の stage()。何も記録しない"""
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def set(self, **items): pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    def __init__(self, name, items, root=None):
+        self.name, self.items = name, dict(items)
+        self.root = root
+        self.records = []  # ルート（run）のときだけ使う、開始順の内訳
+        # tracemalloc が動いていたときだけ入る（途中で計測を有効にした場合、親の stage には無い）
+        self._mem_start = self._peak_seen = None
+
+    def set(self, **items):
+        """処理件数などを後から追加する"""
+        self.items.update(items)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None: stack = _local.stack = []
+        self.depth = len(stack)
+        if self.root is None and stack: self.root = stack[0]
+        self.parent = stack[-1] if stack else None
+        # 内訳は開始順に並べたいので、枠だけ先にルートへ登録しておく
+        self._record = {}
+        if self.root is not None and self.root is not self: self.root.records.append(self._record)
+        self._thread, self._shared = threading.get_ident(), False
+        if tracemalloc.is_tracing():
+            with _open_lock:
+                # 別スレッドで実行中の stage があれば、双方ともピークが混ざるので測定不可にする
+                others = [s for s in _open_stages if s._thread != self._thread]
+                for s in others: s._shared = True
+                self._shared = bool(others)
+                current, peak = tracemalloc.get_traced_memory()
+                if self.parent is not None and self.parent._peak_seen is not None: self.parent._peak_seen = max(self.parent._peak_seen, peak)
+                if not self._shared: tracemalloc.reset_peak()
+                self._mem_start = self._peak_seen = current
+                _open_stages.append(self)
+        stack.append(self)
+        self._wall, self._cpu = time.perf_counter(), time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall, cpu = time.perf_counter() - self._wall, time.thread_time() - self._cpu
+        _local.stack.pop()
+        record = self._record
+        record.update({'stage': self.name, 'depth': self.depth, 'wall_sec': wall, 'cpu_sec': cpu, 'peak_mb': None, 'items': self.items})
+        if self._mem_start is not None:
+            with _open_lock:
+                if self in _open_stages: _open_stages.remove(self)
+                if self._shared:
+                    record['peak_shared'] = True
+                elif tracemalloc.is_tracing():
+                    # 入れ子の stage が reset_peak() するので、子のピークも含めた最大値を使う
+                    peak = max(self._peak_seen, tracemalloc.get_traced_memory()[1])
+                    record['peak_mb'] = (peak - self._mem_start) / 1024 ** 2
+                    if self.parent is not None and self.parent._peak_seen is not None: self.parent._peak_seen = max(self.parent._peak_seen, peak)
+        if exc_type is not None: record['error'] = exc_type.__name__
+        if self.root is None or self.root is self: _emit(self, record)
+        return False
+
+def stage(name, **items):
+    """処理段の計測区間（計測無効時はほぼコストなし）"""
+    if not _enabled: return _NULL_STAGE
+    return _Stage(name, items)
+
+def timed(name):
+    """関数全体を stage(name) で計測するデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled: return func(*args, **kwargs)
+            with _Stage(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def run(name, **meta):
+    """1回分の処理（読み込み・スキャンなど）。終了時に内訳をまとめてJSONで出力する"""
+    if not _enabled: return _NULL_STAGE
+    run_stage = _Stage(name, meta)
+    run_stage.root = run_stage
+    return run_stage
+
+def _emit(root, record):
+    report = {
+        'run': root.name,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'thread': threading.current_thread().name,
+        'wall_sec': record['wall_sec'], 'cpu_sec': record['cpu_sec'], 'peak_mb': record['peak_mb'],
+        'meta': root.items,
+        'stages': root.records
+    }
+    if 'error' in record: report['error'] = record['error']
+    if record.get('peak_shared'): report['peak_shared'] = True
+    line = json.dumps(report, ensure_ascii=False, default=str)
+    logger.info(line)
+    if _log_path:
+        with open(_log_path, 'a', encoding='utf-8') as f: f.write(line + '\n')
+    root.report = report
+    with _last_runs_lock:
+        _last_runs[root.name] = report
+
+class SamplingProfiler:
+    """
+    対象スレッドのスタックを一定間隔で採取し、flamegraph.pl / speedscope で読める
+    folded 形式（"関数;関数;... 回数"）で書き出す。計測中だけ採取用のスレッドが1本動く。
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.counts[';'.join(reversed(names))] += 1
+
+    def __enter__(self):
+        if self.thread_id is None: self.thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+    def dump(self, path):
+        """folded 形式で書き出し、採取数を返す"""
+        with open(path, 'w', encoding='utf-8') as f: f.write(self.folded())
+        return sum(self.counts.values())
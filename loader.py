@@ -1,21 +1,202 @@
 import pandas as pd
 import numpy as np
 import pyxdf
-import streamlit as st
+import logging
 import json
 import tempfile
 import os
+import sys
+import hashlib
+import threading
+from preprocess import build_marker_index
+from instrumentation import stage
 
-@st.cache_data(show_spinner="XDFファイルを解析中...")
-def load_xdf(uploaded_file):
+logger = logging.getLogger(__name__)
+
+# 一時ファイルやメモリマップの置き場所
+CACHE_DIR = os.environ.get('EEGCHECK_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'eegcheck'))
+# 信号のメモリマップ（*.dat）の合計容量の上限（超えたら最終利用が古いものから削除）
+MEMMAP_MAX_BYTES = int(float(os.environ.get('EEGCHECK_MEMMAP_MAX_MB', 4096)) * 1024 ** 2)
+_COPY_CHUNK_BYTES = 8 * 1024 ** 2
+
+def _peak_rss_mb():
+    """プロセス起動からのピーク常駐メモリ(MB)。他のセッションの分も含む。取得できない環境では None"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def _current_rss_mb():
+    """現在の常駐メモリ(MB)。/proc の無い環境では None"""
+    try:
+        with open('/proc/self/statm') as f: pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+class _RssMonitor:
+    """with の間だけ一定間隔で常駐メモリを測り、開始時からの最大増加量(MB)を peak_increase_mb に入れる"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_increase_mb = None
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while True:
+            rss = _current_rss_mb()
+            self.peak_increase_mb = max(self.peak_increase_mb, rss - self._start)
+            if self._stop.wait(self.interval): break
+
+    def __enter__(self):
+        self._start = _current_rss_mb()
+        if self._start is None: return self
+        self.peak_increase_mb = 0.0
+        self._thread = threading.Thread(target=self._sample, name='rss-monitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._start is not None:
+            self._stop.set()
+            self._thread.join()
+        return False
+
+def _spool_to_disk(source):
     """
-    特定の形式のXDFファイル（ラベル無し、先頭2chがEEG）を読み込むことに特化したローダー。
+    アップロードをチャンク単位で一時ファイルへ書き出しつつSHA-1を計算する（全体をメモリに載せない）。
+    パスが渡された場合はそのまま読み、ハッシュだけ計算する。
     """
+    digest = hashlib.sha1()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            while chunk := f.read(_COPY_CHUNK_BYTES): digest.update(chunk)
+        return os.fspath(source), digest.hexdigest(), False
+
+    source.seek(0)
     with tempfile.NamedTemporaryFile(delete=False, suffix='.xdf') as tmp:
-        tmp.write(uploaded_file.getvalue())
-        path = tmp.name
-    streams, _ = pyxdf.load_xdf(path)
-    os.unlink(path)
+        while chunk := source.read(_COPY_CHUNK_BYTES):
+            digest.update(chunk)
+            tmp.write(chunk)
+    return tmp.name, digest.hexdigest(), True
+
+def _select_stream_ids(path):
+    """ヘッダーだけを見て、EEGとマーカーのストリームIDを選ぶ"""
+    ids = []
+    for info in pyxdf.resolve_streams(path):
+        stream_type = (info.get('type') or '').lower()
+        if 'eeg' in stream_type or stream_type in ['markers', 'marker']:
+            ids.append(info['stream_id'])
+    return ids
+
+def _to_memmap(data, recording_id, dtype, cache_dir=CACHE_DIR, max_bytes=MEMMAP_MAX_BYTES):
+    """(n_ch, n_samples) の信号をローカルディスク上の読み取り専用メモリマップとして保持する"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{recording_id}_{data.shape[0]}ch_{np.dtype(dtype).name}.dat")
+    shape = (data.shape[0], data.shape[1])
+    # 内容はハッシュで一意に決まるので、既にあれば書き直さない
+    if not os.path.exists(path) or os.path.getsize(path) != np.dtype(dtype).itemsize * data.size:
+        # 同じプロセスの別セッション（スレッド）と一時ファイルがぶつからないよう、一意な名前で書いてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.dat.tmp')
+        os.close(fd)
+        mm = np.memmap(tmp_path, dtype=dtype, mode='w+', shape=shape)
+        mm[:] = data
+        mm.flush()
+        del mm
+        os.replace(tmp_path, path)
+    else:
+        os.utime(path)  # 最終利用時刻として使う
+    signal = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+    _evict_signal_files(cache_dir, max_bytes, keep=path)
+    return signal
+
+def list_signal_files(cache_dir=CACHE_DIR):
+    """保存済みの信号のメモリマップ一覧（最終利用が新しい順）"""
+    entries = []
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if not name.endswith('.dat'): continue
+            try: stat = os.stat(os.path.join(cache_dir, name))
+            except OSError: continue
+            entries.append({'name': name, 'size_mb': stat.st_size / 1024 ** 2, 'last_used': pd.Timestamp(stat.st_mtime, unit='s')})
+    df = pd.DataFrame(entries, columns=['name', 'size_mb', 'last_used'])
+    return df.sort_values('last_used', ascending=False, ignore_index=True)
+
+def purge_signal_files(cache_dir=CACHE_DIR):
+    """信号のメモリマップを削除し、削除件数を返す（開いている分は Unix ではマップを閉じるまで中身が残る）"""
+    removed = 0
+    for name in list_signal_files(cache_dir)['name']:
+        try: os.remove(os.path.join(cache_dir, name)); removed += 1
+        except OSError: pass  # Windows では使用中のファイルは消せない
+    return removed
+
+def _evict_signal_files(cache_dir, max_bytes, keep):
+    entries = list_signal_files(cache_dir)
+    total = entries['size_mb'].sum() * 1024 ** 2
+    # 最終利用が古いものから削除（今読み込んだものは残す）
+    for name, size_mb in zip(entries['name'].tolist()[::-1], entries['size_mb'].tolist()[::-1]):
+        if total <= max_bytes: break
+        path = os.path.join(cache_dir, name)
+        if path == keep: continue
+        try: os.remove(path)
+        except OSError: continue
+        total -= size_mb * 1024 ** 2
+
+def channel_labels(info, n_channels):
+    """XDFヘッダーからチャンネル名を読む。ラベルが無ければ先頭2chを Fp1, Fp2、残りを Ch3, Ch4, ... とする"""
+    try:
+        labels = [ch['label'][0] for ch in info['desc'][0]['channels'][0]['channel']]
+        if len(labels) == n_channels and all(labels): return labels
+    except (KeyError, IndexError, TypeError):
+        pass
+    return (['Fp1', 'Fp2'] + [f'Ch{i + 1}' for i in range(2, n_channels)])[:n_channels]
+
+def _channel_indices(labels, channels):
+    """チャンネル名・番号（負の番号は末尾から）を 0 以上のチャンネル番号に直す。見つからなければ ValueError"""
+    if channels is None: return list(range(len(labels)))
+    indices = []
+    for ch in channels:
+        if isinstance(ch, (int, np.integer)):
+            if not -len(labels) <= ch < len(labels): raise ValueError(f"チャンネル番号 {ch} が範囲外です（{len(labels)}チャンネル）。")
+            indices.append(int(ch) % len(labels))
+        elif ch in labels: indices.append(labels.index(ch))
+        else: raise ValueError(f"チャンネル '{ch}' がEEGストリームに見つかりません。")
+    if not indices: raise ValueError("読み込むチャンネルが指定されていません。")
+    return indices
+
+def load_xdf(uploaded_file, dtype=None, use_memmap=True, channels=None):
+    """
+    XDFファイルからEEGとマーカーを読み込むローダー。
+    EEGとマーカーのストリームだけをデコードし、信号は dtype（None なら元の型のまま）で
+    ローカルディスク上のメモリマップに保持する。チャンネル名はヘッダーから読み、
+    channels（名前またはインデックスのリスト、None なら全チャンネル）で読み込むチャンネルを選べる。
+    uploaded_file はアップロードされたファイルオブジェクトかファイルパス。読み込めない場合は ValueError。
+    load_stats の load_rss_mb は読み込み中の常駐メモリの最大増加量（同じプロセスで並行する処理の分を含み、
+    プロセスが既に確保していたメモリの再利用分は含まない）。process_peak_rss_mb はプロセス起動からのピーク。
+    """
+    with _RssMonitor() as rss:
+        result = _load_xdf(uploaded_file, dtype, use_memmap, channels)
+    eeg_stream = result['eeg_stream']
+    result['load_stats'] = {
+        'payload_mb': eeg_stream['data'].nbytes / 1024 ** 2,
+        'load_rss_mb': rss.peak_increase_mb,
+        'process_peak_rss_mb': _peak_rss_mb(),
+        'memmap': use_memmap
+    }
+    logger.info("EEGデータ読み込み完了 (SampleRate: %s Hz, 信号: %.1f MB, 読み込み中のRSS増加: %s MB)",
+                eeg_stream['sfreq'], result['load_stats']['payload_mb'], result['load_stats']['load_rss_mb'])
+    return result
+
+def _load_xdf(uploaded_file, dtype, use_memmap, channels):
+    with stage('loader.spool'):
+        path, digest, is_temp = _spool_to_disk(uploaded_file)
+    try:
+        with stage('loader.decode', file_mb=os.path.getsize(path) / 1024 ** 2):
+            streams, _ = pyxdf.load_xdf(path, select_streams=_select_stream_ids(path) or None)
+    finally:
+        if is_temp: os.unlink(path)
 
     eeg_stream, marker_stream = None, None
     
@@ -24,20 +205,36 @@ def load_xdf(uploaded_file):
         
         # EEGストリームを処理
         if 'eeg' in stream_type:
-            st.info("先頭2チャンネルをEEGデータ(Fp1, Fp2)として読み込みます。")
-            
-            # チャンネル数が2つ以上あるか安全に確認
-            if s['time_series'].shape[1] >= 2:
-                eeg_indices = [0, 1] # 先頭2チャンネルに決め打ち
-                eeg_stream = {
-                    'data': s['time_series'][:, eeg_indices].T,
-                    'times': s['time_stamps'],
-                    'sfreq': float(s['info']['nominal_srate'][0]),
-                    'ch_names': ['Fp1', 'Fp2'] # 名前はFp1, Fp2に固定
-                }
+            time_series = s['time_series']
+            if time_series.ndim != 2 or time_series.shape[1] == 0:
+                raise ValueError("EEGストリームにチャンネルがありません。")
+            labels = channel_labels(s['info'], time_series.shape[1])
+            indices = _channel_indices(labels, channels)
+            logger.info("%dチャンネルをEEGデータとして読み込みます: %s", len(indices), [labels[i] for i in indices])
+
+            # 昇順に連続したチャンネルならスライス（コピーなし）、そうでなければ選んだ分だけコピー
+            if indices == list(range(indices[0], indices[-1] + 1)):
+                selected = time_series[:, indices[0]:indices[-1] + 1].T
             else:
-                st.error("EEGストリームに2チャンネル分のデータがありません。")
-                return None
+                selected = time_series[:, indices].T
+            target_dtype = selected.dtype if dtype is None else np.dtype(dtype)
+            # 返す信号は選んだチャンネルと型で変わるので、フィルターキャッシュや特徴量キャッシュのキーにも含める
+            channel_key = hashlib.sha1(','.join(map(str, indices)).encode()).hexdigest()[:8]
+            recording_id = f"{digest}:ch{channel_key}:{target_dtype.name}"
+            with stage('loader.store', samples=selected.shape[1], channels=selected.shape[0], memmap=use_memmap):
+                if use_memmap:
+                    data = _to_memmap(selected, f"{digest}_{channel_key}", target_dtype)
+                else:
+                    data = np.ascontiguousarray(selected, dtype=target_dtype)
+            # デコード済みの全チャンネル分を早めに解放（ストリームの辞書とローカル変数の両方の参照を外す）
+            s['time_series'] = None
+            del time_series, selected
+            eeg_stream = {
+                'data': data,
+                'times': s['time_stamps'],
+                'sfreq': float(s['info']['nominal_srate'][0]),
+                'ch_names': [labels[i] for i in indices]
+            }
         
         # マーカーを処理
         elif stream_type in ['markers', 'marker']:
@@ -63,38 +260,41 @@ def load_xdf(uploaded_file):
 
     # 最終チェック
     if eeg_stream is None:
-        st.error("EEGストリームが見つかりませんでした。")
-        return None
+        raise ValueError("EEGストリームが見つかりませんでした。")
     if marker_stream is None:
-        st.warning("マーカーストリームが見つかりませんでした。")
+        logger.warning("マーカーストリームが見つかりませんでした。")
         marker_stream = pd.DataFrame(columns=['marker_time', 'marker_value'])
 
-    st.success(f"EEGデータ読み込み完了 (SampleRate: {eeg_stream['sfreq']} Hz)")
-    return {'eeg_stream': eeg_stream, 'markers': marker_stream}
+    del streams
+    with stage('loader.marker_index', markers=len(marker_stream)):
+        marker_index = build_marker_index(marker_stream, eeg_stream['times'], eeg_stream['sfreq'])
+    return {
+        'eeg_stream': eeg_stream,
+        'markers': marker_stream,
+        'marker_index': marker_index,
+        'recording_id': recording_id
+    }
 
 
-@st.cache_data(show_spinner="評価データを解析中...")
 def load_evaluation_data(uploaded_file):
-    """評価データ(CSV/XLSX)を読み込む（この部分は変更なし）"""
+    """評価データ(CSV/XLSX)を読み込む。読み込めない場合は ValueError"""
+    fname = getattr(uploaded_file, 'name', uploaded_file)
+    if not fname.endswith(('.csv', '.xlsx', '.xls')):
+        raise ValueError("サポートされていないファイル形式です。")
     try:
-        fname = uploaded_file.name
         if fname.endswith('.csv'):
             df = pd.read_csv(uploaded_file)
-        elif fname.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(uploaded_file, engine='openpyxl')
         else:
-            st.error("サポートされていないファイル形式です。")
-            return None
-        df.columns = df.columns.str.strip()
-        if 'img_id' not in df.columns:
-            st.error("評価データに必須列 'img_id' が見つかりません。")
-            return None
-        df['img_id'] = pd.to_numeric(df['img_id'], errors='coerce').dropna().astype(int)
-        for col in ['Dislike_Like', 'sam_val', 'sam_aro']:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-        st.success(f"評価データ読み込み完了 ({len(df)}件)")
-        return df
+            df = pd.read_excel(uploaded_file, engine='openpyxl')
     except Exception as e:
-        st.error(f"評価データの読み込みに失敗しました: {e}")
-        return None
+        raise ValueError(f"評価データの読み込みに失敗しました: {e}") from e
+
+    df.columns = df.columns.str.strip()
+    if 'img_id' not in df.columns:
+        raise ValueError("評価データに必須列 'img_id' が見つかりません。")
+    df['img_id'] = pd.to_numeric(df['img_id'], errors='coerce').dropna().astype(int)
+    for col in ['Dislike_Like', 'sam_val', 'sam_aro']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    logger.info("評価データ読み込み完了 (%d件)", len(df))
+    return df
@@ -1,51 +1,152 @@
 import numpy as np
 from scipy.signal import butter, sosfiltfilt, iirnotch, filtfilt
-import streamlit as st
-import copy
+import logging
+import threading
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from instrumentation import stage
 
-def apply_filters(eeg_data, freq_range, apply_notch=True):
-    """EEGデータにフィルターを適用"""
-    filtered_data = copy.deepcopy(eeg_data)
-    signal_data = filtered_data['eeg_stream']['data']
-    sfreq = filtered_data['eeg_stream']['sfreq']
-    nyquist = 0.5 * sfreq
+logger = logging.getLogger(__name__)
+
+# フィルター結果キャッシュの上限（バイト）。超えたら古いものから破棄する
+FILTER_CACHE_MAX_BYTES = 512 * 1024 ** 2
 
+_filter_cache = OrderedDict()
+_filter_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=32)
+def design_filters(sfreq, low, high, apply_notch):
+    """バンドパス(SOS)とノッチ(b, a)の係数を設計する（同じ条件なら再利用）"""
+    # 4次Butterworthバンドパスフィルター
+    sos = butter(4, [low, high], btype='band', fs=sfreq, output='sos')
+    # 50Hzノッチフィルター
+    notch = iirnotch(50.0, Q=30, fs=sfreq) if apply_notch else None
+    return sos, notch
+
+def clear_filter_cache():
+    """フィルター結果キャッシュを空にする"""
+    with _filter_cache_lock:
+        _filter_cache.clear()
+
+def _store_filtered(key, filtered_signal):
+    with _filter_cache_lock:
+        _filter_cache[key] = filtered_signal
+        total = sum(arr.nbytes for arr in _filter_cache.values())
+        while total > FILTER_CACHE_MAX_BYTES and _filter_cache:
+            _, evicted = _filter_cache.popitem(last=False)
+            total -= evicted.nbytes
+
+def effective_band(sfreq, freq_range):
+    """サンプリング周波数で実現できる範囲に収めたバンドパスの (low, high)"""
+    nyquist = 0.5 * sfreq
     low, high = freq_range
     if high >= nyquist:
-        st.error(f"高域カットオフ周波数がナイキスト周波数({nyquist}Hz)以上です。")
+        logger.warning("高域カットオフ周波数がナイキスト周波数(%sHz)以上のため %sHz に変更します。", nyquist, nyquist - 0.1)
         high = nyquist - 0.1
     if low <= 0:
         low = 0.1
-    
-    # 4次Butterworthバンドパスフィルター
-    sos = butter(4, [low, high], btype='band', fs=sfreq, output='sos')
-    filtered_signal = sosfiltfilt(sos, signal_data, axis=1)
+    return float(low), float(high)
 
-    # 50Hzノッチフィルター
-    if apply_notch:
-        b_notch, a_notch = iirnotch(50.0, Q=30, fs=sfreq)
-        filtered_signal = filtfilt(b_notch, a_notch, filtered_signal, axis=1)
-    
-    filtered_data['eeg_stream']['data'] = filtered_signal
-    return filtered_data
+def apply_filters(eeg_data, freq_range, apply_notch=True):
+    """
+    EEGデータにフィルターを適用。
+    結果は記録ID・帯域・ノッチ有無ごとにキャッシュし、時刻やマーカーはコピーせず元データと共有する。
+    """
+    eeg_stream = eeg_data['eeg_stream']
+    signal_data = eeg_stream['data']
+    sfreq = eeg_stream['sfreq']
+    low, high = effective_band(sfreq, freq_range)
+
+    recording_id = eeg_data.get('recording_id')
+    key = (recording_id, float(low), float(high), bool(apply_notch))
+    with stage('preprocess.filter', samples=signal_data.shape[1], channels=signal_data.shape[0]) as s:
+        with _filter_cache_lock:
+            filtered_signal = _filter_cache.get(key)
+            if filtered_signal is not None: _filter_cache.move_to_end(key)
+        s.set(cache_hit=filtered_signal is not None)
+
+        if filtered_signal is None:
+            sos, notch = design_filters(sfreq, float(low), float(high), bool(apply_notch))
+            filtered_signal = sosfiltfilt(sos, signal_data, axis=1)
+            if notch is not None:
+                filtered_signal = filtfilt(*notch, filtered_signal, axis=1)
+            # キャッシュ内の配列を共有するため読み取り専用にしておく
+            filtered_signal.flags.writeable = False
+            if recording_id is not None: _store_filtered(key, filtered_signal)
+
+    filtered_id = None if recording_id is None else f"{recording_id}:bp{low}-{high}{':notch' if apply_notch else ''}"
+    return {**eeg_data, 'eeg_stream': {**eeg_stream, 'data': filtered_signal}, 'recording_id': filtered_id}
+
+def select_channels(eeg_data, channels):
+    """指定したチャンネルだけを持つデータを返す（連続したチャンネルならビュー。時刻・マーカーは共有）"""
+    stream = eeg_data['eeg_stream']
+    if channels is None or list(channels) == list(stream['ch_names']): return eeg_data
+    if not len(channels): raise ValueError("チャンネルが指定されていません。")
+    missing = [ch for ch in channels if ch not in stream['ch_names']]
+    if missing: raise ValueError(f"チャンネル {missing} がEEGストリームに見つかりません。")
+    indices = [stream['ch_names'].index(ch) for ch in channels]
+    if indices == list(range(indices[0], indices[-1] + 1)):
+        data = stream['data'][indices[0]:indices[-1] + 1]
+    else:
+        data = stream['data'][indices]
+    recording_id = eeg_data.get('recording_id')
+    channel_key = hashlib.sha1(','.join(channels).encode()).hexdigest()[:8]
+    return {
+        **eeg_data,
+        'eeg_stream': {**stream, 'data': data, 'ch_names': list(channels)},
+        'recording_id': None if recording_id is None else f"{recording_id}:ch{channel_key}"
+    }
+
+def build_marker_index(markers, time_stamps, sfreq):
+    """
+    画像ID→マーカー時刻・サンプル位置の索引をマーカー時刻順に作る（読み込み時に1回だけ）。
+    同じ画像IDが複数あれば最初のマーカーを使う。
+    サンプル位置はマーカー時刻以降の最初のサンプル（記録の範囲外のマーカーは sfreq で外挿する）。
+    """
+    first = markers.drop_duplicates('marker_value').sort_values('marker_time', kind='stable')
+    img_ids = first['marker_value'].to_numpy()
+    marker_times = first['marker_time'].to_numpy(dtype=float)
+    marker_samples = np.searchsorted(time_stamps, marker_times, side='left').astype(np.int64)
+    if len(time_stamps) and len(marker_times):
+        before, after = marker_times < time_stamps[0], marker_times > time_stamps[-1]
+        marker_samples[before] = -np.floor((time_stamps[0] - marker_times[before]) * sfreq).astype(np.int64)
+        marker_samples[after] = len(time_stamps) - 1 + np.ceil((marker_times[after] - time_stamps[-1]) * sfreq).astype(np.int64)
+    return {
+        'img_ids': img_ids,
+        'marker_times': marker_times,
+        'marker_samples': marker_samples,
+        'rows': {img_id: row for row, img_id in enumerate(img_ids.tolist())}
+    }
+
+def get_marker_index(eeg_data):
+    """読み込み時に作成済みのマーカー索引を返す（無ければその場で作る）"""
+    index = eeg_data.get('marker_index')
+    if index is None:
+        stream = eeg_data['eeg_stream']
+        index = build_marker_index(eeg_data['markers'], stream['times'], stream['sfreq'])
+    return index
+
+def epoch_offsets(sfreq, time_range):
+    """マーカー位置から見たエポックの開始・終了（終了は含まない）のサンプル数。全エポックで同じ長さになる"""
+    return int(round(time_range[0] * sfreq)), int(round(time_range[1] * sfreq)) + 1
 
 def create_epochs(eeg_data, target_img_id, time_range):
-    """特定の画像IDに対するエポックを作成"""
-    markers = eeg_data['markers']
-    if markers.empty or target_img_id not in markers['marker_value'].values:
+    """特定の画像IDに対するエポックを作成（記録の端にかかる分は切り詰める）"""
+    index = get_marker_index(eeg_data)
+    row = index['rows'].get(target_img_id)
+    if row is None:
         return None
 
-    marker_time = markers[markers['marker_value'] == target_img_id].iloc[0]['marker_time']
-    
+    marker_time = index['marker_times'][row]
+
     signal_data = eeg_data['eeg_stream']['data']
     time_stamps = eeg_data['eeg_stream']['times']
     sfreq = eeg_data['eeg_stream']['sfreq']
 
-    start_time = marker_time + time_range[0]
-    end_time = marker_time + time_range[1]
-
-    start_idx = np.searchsorted(time_stamps, start_time, side='left')
-    end_idx = np.searchsorted(time_stamps, end_time, side='right')
+    offset_start, offset_end = epoch_offsets(sfreq, time_range)
+    start_idx = max(index['marker_samples'][row] + offset_start, 0)
+    end_idx = min(index['marker_samples'][row] + offset_end, len(time_stamps))
 
     if start_idx >= end_idx:
         return None
@@ -59,3 +160,55 @@ def create_epochs(eeg_data, target_img_id, time_range):
         'sfreq': sfreq,
         'img_id': target_img_id
     }
+
+def epoch_bounds(eeg_data, time_range):
+    """全マーカーのエポック範囲（サンプル番号、記録の範囲に切り詰めたもの）を、マーカー時刻順にまとめて求める"""
+    index = get_marker_index(eeg_data)
+    n_samples = len(eeg_data['eeg_stream']['times'])
+    offset_start, offset_end = epoch_offsets(eeg_data['eeg_stream']['sfreq'], time_range)
+
+    start_idx = np.clip(index['marker_samples'] + offset_start, 0, n_samples)
+    end_idx = np.clip(index['marker_samples'] + offset_end, 0, n_samples)
+    return index['img_ids'], index['marker_times'], start_idx, end_idx
+
+def create_epochs_batch(eeg_data, time_range, img_ids=None):
+    """
+    全試行（または img_ids で指定した試行）のエポックを (n_epochs, n_channels, n_samples) の1つの配列にまとめて作成する。
+    各エポックはマーカー位置から同じサンプル数だけ取り出し、記録の端にかかる分は 0 で埋める。
+    'valid' は (n_epochs, n_samples) の有効サンプルマスク、'start_idx' は端で切り詰める前の開始サンプル番号。
+    """
+    index = get_marker_index(eeg_data)
+    rows = np.arange(len(index['img_ids']))
+    if img_ids is not None:
+        rows = np.array([index['rows'][i] for i in img_ids if i in index['rows']], dtype=np.int64)
+
+    signal_data = eeg_data['eeg_stream']['data']
+    n_samples = signal_data.shape[1]
+    offset_start, offset_end = epoch_offsets(eeg_data['eeg_stream']['sfreq'], time_range)
+    epoch_len = offset_end - offset_start
+    start_idx = index['marker_samples'][rows] + offset_start
+
+    # 記録と全く重ならないエポックは除外する（create_epochs が None を返すケース）
+    keep = (start_idx < n_samples) & (start_idx + epoch_len > 0)
+    rows, start_idx = rows[keep], start_idx[keep]
+    sample_idx = start_idx[:, None] + np.arange(epoch_len)
+    valid = (sample_idx >= 0) & (sample_idx < n_samples)
+
+    with stage('preprocess.epochs', epochs=len(rows), samples=int(valid.sum())):
+        data = np.zeros((len(rows), signal_data.shape[0], epoch_len), dtype=signal_data.dtype)
+        full = valid.all(axis=1)
+        if full.any():
+            # ストライドビュー上で開始位置を1回だけ取り出す（マーカー間隔が不規則なためここで1回だけ集約コピーが発生）
+            windows = np.lib.stride_tricks.sliding_window_view(signal_data, epoch_len, axis=1)
+            data[full] = windows[:, start_idx[full]].transpose(1, 0, 2)
+        for i in np.flatnonzero(~full):
+            data[i][:, valid[i]] = signal_data[:, sample_idx[i][valid[i]]]
+
+    return {
+        'data': data,
+        'valid': valid,
+        'img_ids': index['img_ids'][rows],
+        'marker_times': index['marker_times'][rows],
+        'start_idx': start_idx,
+        'sfreq': eeg_data['eeg_stream']['sfreq']
+    }
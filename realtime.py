@@ -0,0 +1,286 @@
+"""
+EEGを逐次受信しながらアーチファクトを判定するリアルタイムモード（Streamlit不要）。
+
+    python realtime.py recording.xdf --thresholds thresholds.json            # XDFを実時間で再生
+    python realtime.py recording.xdf --thresholds thresholds.json --speed 0  # 待ち時間なしで再生
+    python realtime.py --lsl EEG --thresholds thresholds.json                # LSLストリームを受信（pylsl が必要）
+
+フィルターは apply_filters と同じ設計（バンドパス + 50Hzノッチ）を因果的に sosfilt で掛け、
+フィルター状態をチャンク間で引き継ぐ。ゼロ位相ではないため、オフライン解析とは位相遅れの分だけ値が異なる。
+ウィンドウ（既定 0.5秒 / 0.1秒ステップ、記録先頭から数えた格子）は揃った分だけリングバッファから計算し、
+ウィンドウ最後のサンプルが到着してから判定するまでの時間（遅延）と、チャンクを受け取ってからの処理時間を記録する。
+サンプルの到着時刻は、LSL ではそのサンプルのタイムスタンプ（ローカル時計に補正済み）、XDF再生では記録上そのサンプルが届く時刻。
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+import numpy as np
+from scipy.signal import sosfilt, sosfilt_zi, tf2sos
+from preprocess import design_filters, effective_band
+from features import compute_window_features, window_params, FEATURE_NAMES, WINDOW_SIZE_SEC, STEP_SIZE_SEC
+
+logger = logging.getLogger('realtime')
+
+# 再生・受信の1チャンクの長さ（秒）。1チャンクあたりの処理量＝判定遅延の上限を決める
+CHUNK_SEC = 0.04
+
+class CausalFilter:
+    """apply_filters と同じ係数の因果フィルター。チャンクごとに呼んでも連続信号に1回掛けた結果と一致する"""
+
+    def __init__(self, sfreq, freq_range, apply_notch=True):
+        sos, notch = design_filters(sfreq, *effective_band(sfreq, freq_range), bool(apply_notch))
+        self.sos = np.vstack([sos, tf2sos(*notch)]) if notch is not None else sos
+        self._zi = None
+
+    def process(self, chunk):
+        """(n_ch, n_samples) のチャンクをフィルターする"""
+        if self._zi is None:
+            # 最初のサンプルで定常状態から始め、立ち上がりの過渡応答で誤判定しないようにする
+            self._zi = sosfilt_zi(self.sos)[:, None, :] * chunk[:, :1][None, :, :]
+        filtered, self._zi = sosfilt(self.sos, chunk, axis=1, zi=self._zi)
+        return filtered
+
+def threshold_matrix(thresholds, ch_names):
+    """
+    閾値辞書を (n_ch, n_features) の行列にする（閾値なしは inf）。
+    features.rejection_mask の long 形式と同じく 'amplitude' は全チャンネル、'Fp1_amplitude' はそのチャンネルだけに適用する。
+    """
+    matrix = np.full((len(ch_names), len(FEATURE_NAMES)), np.inf)
+    for key, val in thresholds.items():
+        if key in FEATURE_NAMES:
+            matrix[:, FEATURE_NAMES.index(key)] = val
+            continue
+        ch_name, _, feat_name = key.rpartition('_')
+        if ch_name in ch_names and feat_name in FEATURE_NAMES:
+            matrix[ch_names.index(ch_name), FEATURE_NAMES.index(feat_name)] = val
+        else:
+            logger.warning("特徴量に存在しない閾値キーを無視します: %s", key)
+    return matrix
+
+class OnlineDetector:
+    """
+    受信したチャンクをフィルターしてリングバッファに溜め、新しく揃ったウィンドウだけ特徴量を計算して閾値判定する。
+    push() は除去対象になったウィンドウの一覧を返す。
+    """
+
+    def __init__(self, sfreq, ch_names, thresholds, freq_range=(1.0, 50.0), apply_notch=True, buffer_sec=5.0,
+                 window_size_sec=WINDOW_SIZE_SEC, step_size_sec=STEP_SIZE_SEC):
+        # features.py と同じく整数化したサンプリング周波数でウィンドウ長を決める
+        self.sfreq = int(sfreq)
+        self.ch_names = list(ch_names)
+        self.window_samples, self.step_samples = window_params(self.sfreq, window_size_sec, step_size_sec)
+        self._filter = CausalFilter(sfreq, freq_range, apply_notch)
+        self.set_thresholds(thresholds)
+
+        capacity = max(int(buffer_sec * sfreq), 2 * self.window_samples)
+        self._buffer = np.empty((len(self.ch_names), capacity))
+        self._times = np.empty(capacity)
+        self._arrivals = np.empty(capacity)
+        self._buffer_start = 0  # バッファ先頭のサンプル番号（記録先頭から）
+        self._buffered = 0
+        self._next_window = 0   # 次に計算するウィンドウの先頭サンプル番号
+
+        self.n_windows, self.n_flagged = 0, 0
+        self.latencies, self.processing, self.chunk_seconds = [], [], []
+        self.signal_sec = 0.0
+
+    def set_thresholds(self, thresholds):
+        """判定に使う閾値を差し替える（次のウィンドウから適用）"""
+        self.thresholds = dict(thresholds)
+        self._threshold_matrix = threshold_matrix(self.thresholds, self.ch_names)
+
+    def _append(self, filtered, timestamps, arrivals):
+        n_new = filtered.shape[1]
+        capacity = self._buffer.shape[1]
+        if self._buffered + n_new > capacity:
+            # 判定済みのサンプルを捨て、未判定の分だけ先頭へ詰める
+            drop = self._next_window - self._buffer_start
+            keep = self._buffered - drop
+            if keep + n_new > capacity:
+                capacity = keep + n_new
+                buffer, times, arrival = np.empty((len(self.ch_names), capacity)), np.empty(capacity), np.empty(capacity)
+            else:
+                buffer, times, arrival = self._buffer, self._times, self._arrivals
+            buffer[:, :keep] = self._buffer[:, drop:self._buffered]
+            times[:keep] = self._times[drop:self._buffered]
+            arrival[:keep] = self._arrivals[drop:self._buffered]
+            self._buffer, self._times, self._arrivals = buffer, times, arrival
+            self._buffer_start, self._buffered = self._next_window, keep
+        self._buffer[:, self._buffered:self._buffered + n_new] = filtered
+        self._times[self._buffered:self._buffered + n_new] = timestamps
+        self._arrivals[self._buffered:self._buffered + n_new] = arrivals
+        self._buffered += n_new
+
+    def push(self, chunk, timestamps, arrivals=None, clock=time.perf_counter):
+        """
+        (n_ch, n_samples) のチャンクを処理し、閾値を超えたウィンドウを
+        {'start_time', 'end_time', 'exceeded', 'latency_ms', 'processing_ms'} のリストで返す。
+        arrivals は各サンプルの到着時刻（clock() と同じ時計、None なら全サンプルが呼び出し時刻に届いたとみなす）。
+        latency_ms はウィンドウ最後のサンプルの到着から判定まで、processing_ms は push() の呼び出しから判定まで。
+        """
+        received = time.perf_counter()
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.shape[1] == 0: return []
+        if arrivals is None: arrivals = clock()
+        self._append(self._filter.process(chunk), timestamps, arrivals)
+        self.signal_sec += chunk.shape[1] / self.sfreq
+
+        # 新しいウィンドウはすべてこのチャンクで最後のサンプルが揃ったもの
+        total = self._buffer_start + self._buffered
+        n_ready = (total - self._next_window - self.window_samples) // self.step_samples + 1
+        events = []
+        if n_ready > 0:
+            offset = self._next_window - self._buffer_start
+            span = (n_ready - 1) * self.step_samples + self.window_samples
+            values = compute_window_features(self._buffer[:, offset:offset + span], self.sfreq, self.window_samples, self.step_samples)
+            exceeded = values >= self._threshold_matrix
+            flagged = np.flatnonzero(exceeded.any(axis=(1, 2)))
+            now, processing = clock(), time.perf_counter() - received
+            # 各ウィンドウの最後のサンプルが届いてからの時間（チャンクの受信待ちも含む）
+            last = offset + np.arange(n_ready) * self.step_samples + self.window_samples - 1
+            latencies = now - self._arrivals[last]
+            self.latencies.extend(latencies.tolist())
+            self.processing.extend([processing] * n_ready)
+            for w in flagged:
+                start = offset + w * self.step_samples
+                ch_idx, feat_idx = np.nonzero(exceeded[w])
+                events.append({
+                    'start_time': float(self._times[start]),
+                    'end_time': float(self._times[start + self.window_samples - 1]),
+                    'exceeded': {f"{self.ch_names[c]}_{FEATURE_NAMES[f]}": float(values[w, c, f]) for c, f in zip(ch_idx, feat_idx)},
+                    'latency_ms': float(latencies[w]) * 1000,
+                    'processing_ms': processing * 1000
+                })
+            self._next_window += n_ready * self.step_samples
+            self.n_windows += n_ready
+            self.n_flagged += len(flagged)
+        self.chunk_seconds.append(time.perf_counter() - received)
+        return events
+
+    def latency_stats(self):
+        """サンプル到着→判定の遅延、受信後の処理時間、チャンク処理時間の要約（ミリ秒）"""
+        latencies = np.array(self.latencies) * 1000
+        processing = np.array(self.processing) * 1000
+        chunk_ms = np.array(self.chunk_seconds) * 1000
+        return {
+            'windows': self.n_windows,
+            'flagged': self.n_flagged,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+            'latency_max_ms': float(latencies.max()) if len(latencies) else None,
+            'processing_p50_ms': float(np.percentile(processing, 50)) if len(processing) else None,
+            'processing_p95_ms': float(np.percentile(processing, 95)) if len(processing) else None,
+            'chunk_p95_ms': float(np.percentile(chunk_ms, 95)) if len(chunk_ms) else None,
+            # 処理時間 / 信号の長さ（1以上なら受信に追いつけていない）
+            'load': float(chunk_ms.sum() / 1000 / self.signal_sec) if self.signal_sec else None
+        }
+
+class XdfReplaySource:
+    """XDFファイルのEEGをチャンクに分けて記録時と同じ間隔で送り出す（speed=0 なら待たずに送る）"""
+
+    def __init__(self, path, chunk_sec=CHUNK_SEC, speed=1.0, channels=None):
+        from loader import load_xdf
+        eeg_stream = load_xdf(path, use_memmap=False, channels=channels)['eeg_stream']
+        self.sfreq, self.ch_names = eeg_stream['sfreq'], eeg_stream['ch_names']
+        self._data, self._times = eeg_stream['data'], eeg_stream['times']
+        self.chunk_samples = max(1, int(round(chunk_sec * self.sfreq)))
+        self.speed = speed
+
+    # 到着時刻の時計
+    clock = staticmethod(time.perf_counter)
+
+    def chunks(self):
+        """(timestamps, data (n_ch, n), 各サンプルの到着時刻) を順に返す"""
+        t0, wall0 = self._times[0], time.perf_counter()
+        for start in range(0, len(self._times), self.chunk_samples):
+            stop = min(start + self.chunk_samples, len(self._times))
+            if self.speed:
+                # 各サンプルは記録された時刻に届いたものとし、チャンク最後のサンプルが届くまで待って送る
+                arrivals = wall0 + (self._times[start:stop] - t0) / self.speed
+                wait = arrivals[-1] - time.perf_counter()
+                if wait > 0: time.sleep(wait)
+            else:
+                arrivals = np.full(stop - start, time.perf_counter())
+            yield self._times[start:stop], self._data[:, start:stop], arrivals
+
+class LslSource:
+    """LSLのEEGストリームからチャンクを受信する（pylsl が必要）"""
+
+    def __init__(self, stream_type='EEG', chunk_sec=CHUNK_SEC, timeout=10.0):
+        try:
+            import pylsl
+        except ImportError as e:
+            raise ImportError("LSLストリームの受信には pylsl が必要です（pip install pylsl）。") from e
+        streams = pylsl.resolve_byprop('type', stream_type, timeout=timeout)
+        if not streams: raise ValueError(f"type='{stream_type}' のLSLストリームが見つかりません。")
+        # タイムスタンプをローカル時計（pylsl.local_clock）に補正して受け取る
+        self._inlet = pylsl.StreamInlet(streams[0], processing_flags=pylsl.proc_clocksync)
+        self.clock = pylsl.local_clock
+        info = self._inlet.info()
+        self.sfreq = info.nominal_srate()
+        labels, channel = [], info.desc().child('channels').child('channel')
+        for i in range(info.channel_count()):
+            labels.append(channel.child_value('label') or f'Ch{i + 1}')
+            channel = channel.next_sibling()
+        self.ch_names = labels
+        self.chunk_samples = max(1, int(round(chunk_sec * self.sfreq)))
+        self._timeout = chunk_sec
+
+    def chunks(self):
+        """(timestamps, data (n_ch, n), 各サンプルの到着時刻) を受信し続ける（1チャンクは最大 chunk_samples）"""
+        while True:
+            samples, timestamps = self._inlet.pull_chunk(timeout=self._timeout, max_samples=self.chunk_samples)
+            # サンプルの到着時刻は送信側で付けられたタイムスタンプ（送信〜受信待ちの時間も遅延に含める）
+            if timestamps: yield np.asarray(timestamps), np.asarray(samples, dtype=float).T, np.asarray(timestamps)
+
+def run(source, thresholds, freq_range=(1.0, 50.0), apply_notch=True, on_event=None, window_size_sec=WINDOW_SIZE_SEC, step_size_sec=STEP_SIZE_SEC):
+    """ソースが尽きるまで判定を続け、遅延の要約を返す（Ctrl+C で中断しても要約は返す）"""
+    detector = OnlineDetector(source.sfreq, source.ch_names, thresholds, freq_range, apply_notch,
+                              window_size_sec=window_size_sec, step_size_sec=step_size_sec)
+    try:
+        for timestamps, chunk, arrivals in source.chunks():
+            for event in detector.push(chunk, timestamps, arrivals, source.clock):
+                if on_event: on_event(event)
+    except KeyboardInterrupt:
+        logger.info("中断しました。")
+    return detector.latency_stats()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EEGを逐次受信しながらアーチファクトを判定します。")
+    parser.add_argument('xdf', nargs='?', help="再生するXDFファイル（--lsl を使う場合は不要）")
+    parser.add_argument('--lsl', metavar='TYPE', help="受信するLSLストリームの type（例: EEG）")
+    parser.add_argument('--thresholds', required=True, help="閾値設定JSON（例: {\"amplitude\": 150, \"Fp1_gamma\": 25}）")
+    parser.add_argument('--band', type=float, nargs=2, default=(1.0, 50.0), metavar=('LOW', 'HIGH'), help="バンドパス (Hz)")
+    parser.add_argument('--no-notch', action='store_true', help="50Hzノッチフィルターを使わない")
+    parser.add_argument('--channels', nargs='+', default=None, help="判定するチャンネル名（XDF再生時のみ、既定: 全チャンネル）")
+    parser.add_argument('--window', type=float, default=WINDOW_SIZE_SEC, help="ウィンドウ長(秒)")
+    parser.add_argument('--step', type=float, default=STEP_SIZE_SEC, help="ウィンドウのステップ(秒)")
+    parser.add_argument('--chunk-sec', type=float, default=CHUNK_SEC, help="1チャンクの長さ(秒)")
+    parser.add_argument('--speed', type=float, default=1.0, help="XDF再生の速度倍率（0 なら待たずに再生）")
+    parser.add_argument('--out', help="除去対象ウィンドウと遅延の要約を書き出すJSON")
+    args = parser.parse_args(argv)
+    if not args.xdf and not args.lsl: parser.error("XDFファイルか --lsl のどちらかを指定してください。")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    with open(args.thresholds, encoding='utf-8') as f: thresholds = json.load(f)
+    if args.lsl: source = LslSource(args.lsl, args.chunk_sec)
+    else: source = XdfReplaySource(args.xdf, args.chunk_sec, args.speed, args.channels)
+
+    events = []
+    def on_event(event):
+        events.append(event)
+        logger.info("除去: %.2f-%.2f %s (%.1f ms)", event['start_time'], event['end_time'], ', '.join(event['exceeded']), event['latency_ms'])
+
+    stats = run(source, thresholds, tuple(args.band), not args.no_notch, on_event, args.window, args.step)
+    if not stats['windows']: print("判定できるウィンドウがありませんでした。"); return 0
+    print(f"ウィンドウ {stats['windows']} / 除去 {stats['flagged']}, 遅延 p50 {stats['latency_p50_ms']:.2f} ms / "
+          f"p95 {stats['latency_p95_ms']:.2f} ms / 最大 {stats['latency_max_ms']:.2f} ms, "
+          f"処理 p50 {stats['processing_p50_ms']:.2f} ms / p95 {stats['processing_p95_ms']:.2f} ms, 負荷 {stats['load']:.3f}")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f: json.dump({'stats': stats, 'events': events}, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import io
+import numpy as np
+import pandas as pd
+from preprocess import epoch_bounds, create_epochs_batch
+
+def merge_intervals(starts, ends):
+    """
+    重なり合う区間を統合する（1グループ分）。
+    開始時刻でソートし、それまでの終了時刻の累積最大値より後から始まる区間で新しい区間を開始する。
+    """
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    if len(starts) == 0: return starts[:0], ends[:0]
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    running_end = np.maximum.accumulate(ends)
+    is_new = np.empty(len(starts), dtype=bool)
+    is_new[0] = True
+    is_new[1:] = starts[1:] >= running_end[:-1]
+    first = np.flatnonzero(is_new)
+    return starts[first], np.maximum.reduceat(ends, first)
+
+def merge_rejected_intervals(windows_df):
+    """除去ウィンドウを画像IDごとに統合した区間（エポック先頭からの秒）を全試行まとめて返す"""
+    if windows_df.empty: return pd.DataFrame(columns=['img_id', 'start', 'end'])
+    df = pd.DataFrame({
+        'img_id': windows_df['img_id'].to_numpy(),
+        'start': windows_df['window_start_sec'].to_numpy(),
+        'end': windows_df['window_end_sec'].to_numpy()
+    }).sort_values(['img_id', 'start'], kind='stable')
+    # 画像IDごとの終了時刻の累積最大値（1つ前の行まで）より後に始まる行で新しい区間になる
+    prev_end = df.groupby('img_id', sort=False)['end'].cummax().groupby(df['img_id'], sort=False).shift()
+    interval_id = (prev_end.isna() | (df['start'] >= prev_end)).cumsum()
+    return df.groupby(interval_id, sort=False).agg(img_id=('img_id', 'first'), start=('start', 'min'), end=('end', 'max')).reset_index(drop=True)
+
+def rejection_sample_mask(eeg_data, windows_df, time_range):
+    """除去ウィンドウを連続記録上のサンプル単位のマスク（True = 除去）に変換する"""
+    n_samples = eeg_data['eeg_stream']['data'].shape[1]
+    if windows_df.empty: return np.zeros(n_samples, dtype=bool)
+    # features.py と同じく整数化したサンプリング周波数でウィンドウ位置を求める
+    # （時刻は「サンプル数 / sfreq」なので、四捨五入すれば元のサンプル数に戻る）
+    sfreq = int(eeg_data['eeg_stream']['sfreq'])
+    img_ids, _, epoch_starts, _ = epoch_bounds(eeg_data, time_range)
+    rows = pd.Index(img_ids).get_indexer(windows_df['img_id'].to_numpy())
+    known = rows >= 0
+    base = epoch_starts[rows[known]]
+    starts = base + np.round(windows_df['window_start_sec'].to_numpy()[known] * sfreq).astype(np.int64)
+    ends = base + np.round(windows_df['window_end_sec'].to_numpy()[known] * sfreq).astype(np.int64)
+    starts, ends = np.clip(starts, 0, n_samples), np.clip(ends, 0, n_samples)
+    # 差分配列の累積和が正の区間 = いずれかのウィンドウに含まれるサンプル
+    coverage = np.bincount(starts, minlength=n_samples + 1) - np.bincount(ends, minlength=n_samples + 1)
+    return np.cumsum(coverage[:n_samples]) > 0
+
+def _masked(data, mask):
+    cleaned = np.array(data, dtype=np.float32)
+    cleaned[..., mask] = np.nan
+    return cleaned
+
+def _write(path_or_buffer, fmt, arrays=None, frame=None):
+    if fmt == 'npz':
+        np.savez_compressed(path_or_buffer, **arrays)
+    elif fmt == 'parquet':
+        try:
+            frame.to_parquet(path_or_buffer, index=False)
+        except ImportError as e:
+            raise ImportError("Parquet形式での書き出しには pyarrow が必要です（pip install pyarrow）。") from e
+    else:
+        raise ValueError(f"サポートされていない形式です: {fmt}")
+
+def export_masked_continuous(eeg_data, mask, path_or_buffer, fmt='npz'):
+    """除去サンプルを NaN にした連続信号を書き出す"""
+    stream = eeg_data['eeg_stream']
+    cleaned = _masked(stream['data'], mask)
+    arrays, frame = None, None
+    if fmt == 'npz':
+        arrays = {'data': cleaned, 'times': stream['times'], 'rejected': mask,
+                  'ch_names': np.array(stream['ch_names']), 'sfreq': np.array(stream['sfreq'])}
+    else:
+        frame = pd.DataFrame({'time': stream['times'], **dict(zip(stream['ch_names'], cleaned)), 'rejected': mask})
+    _write(path_or_buffer, fmt, arrays, frame)
+
+def export_cleaned_epochs(eeg_data, mask, time_range, path_or_buffer, fmt='npz'):
+    """除去サンプルを NaN にしたエポックを書き出す（記録の端にかかって足りない分も NaN で埋める）"""
+    stream = eeg_data['eeg_stream']
+    batch = create_epochs_batch(eeg_data, time_range)
+    n_epochs, max_len = batch['valid'].shape
+    offsets = np.arange(max_len)
+    sample_idx = np.clip(batch['start_idx'][:, None] + offsets, 0, len(stream['times']) - 1)
+    # 有効範囲外と除去サンプルをまとめて NaN にする
+    epochs = batch['data'].astype(np.float32)
+    invalid = ~batch['valid'] | mask[sample_idx]
+    epochs[np.broadcast_to(invalid[:, None, :], epochs.shape)] = np.nan
+    times = np.where(batch['valid'], stream['times'][sample_idx] - batch['marker_times'][:, None], np.nan)
+
+    arrays, frame = None, None
+    if fmt == 'npz':
+        arrays = {'epochs': epochs, 'times': times, 'valid': batch['valid'], 'rejected': mask[sample_idx] & batch['valid'],
+                  'img_ids': batch['img_ids'], 'ch_names': np.array(stream['ch_names']), 'sfreq': np.array(stream['sfreq'])}
+    else:
+        valid = batch['valid'].ravel()
+        frame = pd.DataFrame({
+            'img_id': np.repeat(batch['img_ids'], max_len)[valid],
+            'time': times.ravel()[valid],
+            **{ch: epochs[:, i, :].ravel()[valid] for i, ch in enumerate(stream['ch_names'])},
+            'rejected': mask[sample_idx].ravel()[valid]
+        })
+    _write(path_or_buffer, fmt, arrays, frame)
+
+def export_to_bytes(export_func, *args, fmt='npz'):
+    """ダウンロード用に書き出し結果をバイト列で返す"""
+    buffer = io.BytesIO()
+    export_func(*args, buffer, fmt=fmt)
+    return buffer.getvalue()
@@ -0,0 +1,140 @@
+"""
+特徴量スキャンをバックグラウンドのスレッドで実行する（Streamlitに依存しない）。
+
+フィルターと特徴量計算の大部分は numpy / scipy の中で GIL を解放するため、スレッドでも他のセッションの応答を妨げない。
+同時に実行するスキャン数はサーバー全体で MAX_CONCURRENT_SCANS までに制限し、超えた分は順番待ちになる。
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from preprocess import apply_filters, select_channels
+from features import calculate_features_multiresolution, WINDOW_SIZE_SEC, STEP_SIZE_SEC
+from instrumentation import run, stage, SamplingProfiler
+import feature_store
+
+logger = logging.getLogger(__name__)
+
+# サーバー全体で同時に走らせるスキャン数（プロセス内の全セッションで共有）
+MAX_CONCURRENT_SCANS = int(os.environ.get('EEGCHECK_MAX_CONCURRENT_SCANS', 2))
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SCANS, thread_name_prefix='eeg-scan')
+
+class ScanCancelled(Exception):
+    """スキャンが中断されたことを示す"""
+
+class ScanJob:
+    """
+    1回分のスキャンの状態。status は queued / running / done / cancelled / error のいずれか。
+    進捗と途中結果はワーカースレッドが更新し、UI 側はそれを読むだけ。
+    """
+
+    def __init__(self, params, profile_path=None):
+        self.params = params
+        self.profile_path = profile_path
+        self.report = None
+        self.status, self.stage = 'queued', '順番待ち'
+        self.done, self.total = 0, 0
+        self.result, self.error, self.from_store = None, None, False
+        self.started, self.finished = None, None
+        self._cancel = threading.Event()
+        self._partial = None
+        self._future = None
+
+    def cancel(self):
+        """中断を要求する（順番待ちならそのまま取り消し、実行中なら次の試行の区切りで止まる）"""
+        self._cancel.set()
+        if self._future is not None and self._future.cancel():
+            self.status, self.stage = 'cancelled', '中断'
+
+    @property
+    def finished_running(self):
+        return self.status in ('done', 'cancelled', 'error')
+
+    @property
+    def fraction(self):
+        return self.done / self.total if self.total else 0.0
+
+    def partial_frame(self):
+        """その時点までに計算済みの特徴量（まだ無ければ None）"""
+        if self.result is not None: return self.result
+        partial = self._partial
+        return partial() if partial is not None else None
+
+    def _on_progress(self, done, total, partial):
+        if self._cancel.is_set(): raise ScanCancelled()
+        self.done, self.total = done, total
+        if partial is not None: self._partial = partial
+
+    def _run(self, eeg_data):
+        if self._cancel.is_set():
+            self.status, self.stage = 'cancelled', '中断'
+            return
+        self.status, self.started = 'running', time.time()
+        p = self.params
+        # profile_path を指定したスキャンだけサンプリングプロファイラを付ける
+        profiler = SamplingProfiler() if self.profile_path else contextlib.nullcontext()
+        try:
+            with run('scan', recording_id=eeg_data.get('recording_id'), **p) as scan_run, profiler:
+                self._scan(eeg_data)
+            self.report = getattr(scan_run, 'report', None)
+            self.status, self.stage = 'done', '完了'
+        except ScanCancelled:
+            self.status, self.stage = 'cancelled', '中断'
+            logger.info("スキャンを中断しました (%d / %d)", self.done, self.total)
+        except Exception as e:
+            self.error, self.status, self.stage = e, 'error', 'エラー'
+            logger.exception("スキャンに失敗しました")
+        finally:
+            self.finished = time.time()
+            if self.profile_path: logger.info("プロファイルを書き出しました: %s (%d サンプル)", self.profile_path, profiler.dump(self.profile_path))
+
+    def _store_key(self, eeg_data, window_size_sec):
+        p = self.params
+        return feature_store.make_key(eeg_data.get('recording_id'), p['freq_range'], p['notch_filter'], p['time_range'], p['continuous'],
+                                      window_size_sec=window_size_sec, step_size_sec=p['step_size_sec'], channels=p['channels'], layout=p['layout'])
+
+    def _scan(self, eeg_data):
+        p = self.params
+        with stage('store.load'):
+            features_df = feature_store.load_features(self._store_key(eeg_data, p['window_size_sec'])[0])
+        if features_df is not None:
+            self.from_store = True
+            self.result = features_df
+            return
+
+        self.stage = 'フィルター'
+        filtered_eeg = apply_filters(select_channels(eeg_data, p['channels']), p['freq_range'], p['notch_filter'])
+        if self._cancel.is_set(): raise ScanCancelled()
+        self.stage = '特徴量'
+        # 途中結果は表示中のウィンドウ長のものだけを見せる
+        on_progress = lambda done, total, partial: self._on_progress(done, total, partial and (lambda: partial()[p['window_size_sec']]))
+        frames = calculate_features_multiresolution(filtered_eeg, p['time_range'], p['window_sizes'], p['step_size_sec'],
+                                                    continuous=p['continuous'], layout=p['layout'], progress=on_progress)
+        # 一緒に計算した他のウィンドウ長も保存しておき、切り替えたときは再計算せずに読み込む
+        for window_size_sec, features_df in frames.items():
+            store_key, store_params = self._store_key(eeg_data, window_size_sec)
+            with stage('store.save', rows=len(features_df), window_size_sec=window_size_sec):
+                feature_store.save_features(store_key, features_df, store_params)
+        self.result = frames[p['window_size_sec']]
+
+def scan_params(channels, freq_range, notch_filter, time_range, continuous=False, layout='long',
+                window_size_sec=WINDOW_SIZE_SEC, step_size_sec=STEP_SIZE_SEC, window_sizes=None):
+    """
+    スキャン条件の辞書（実行中のジョブと現在の設定が同じかどうかの比較にも使う）。
+    window_sizes に複数のウィンドウ長を渡すと、window_size_sec の結果と一緒に計算して保存する。
+    """
+    window_sizes = tuple(sorted({float(window_size_sec), *(window_sizes or ())}))
+    return {'channels': list(channels), 'freq_range': tuple(freq_range), 'notch_filter': bool(notch_filter),
+            'time_range': tuple(time_range), 'continuous': bool(continuous), 'layout': layout,
+            'window_size_sec': float(window_size_sec), 'step_size_sec': float(step_size_sec), 'window_sizes': window_sizes}
+
+def submit_scan(eeg_data, params, profile_path=None):
+    """
+    scan_params() の条件でスキャンをワーカースレッドに投入し、状態を追跡する ScanJob を返す。
+    profile_path を指定すると、このスキャンのプロファイルを folded 形式で書き出す。
+    """
+    job = ScanJob(params, profile_path)
+    job._future = _executor.submit(job._run, eeg_data)
+    return job
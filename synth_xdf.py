@@ -0,0 +1,152 @@
+"""
+ベンチマーク・動作確認用の合成XDFファイルを生成する（ネットワーク・計測機器不要）。
+
+    python synth_xdf.py out.xdf --sfreq 250 --duration 600 --channels 2 --marker-interval 12
+
+背景脳波（1/f ノイズ + α波 + 50Hz 電源ノイズ）に、まばたき（前頭部の大きくゆっくりした振れ）と
+筋電（高周波のバースト）を既知の位置に埋め込む。埋め込んだ位置は検出結果の正解として使える。
+"""
+import argparse
+import json
+import struct
+import numpy as np
+
+# XDFのチャンクタグ
+_TAG_FILE_HEADER, _TAG_STREAM_HEADER, _TAG_SAMPLES, _TAG_CLOCK_OFFSET, _TAG_STREAM_FOOTER = 1, 2, 3, 4, 6
+_SAMPLES_PER_CHUNK = 4096
+
+def generate_recording(sfreq=250, duration_sec=600.0, n_channels=2, marker_interval_sec=12.0,
+                       blink_rate_per_min=6.0, emg_rate_per_min=2.0, start_time=1000.0, seed=0):
+    """合成EEGと正解のアーチファクト位置を作る。data は (n_samples, n_channels) の float32（µV）"""
+    rng = np.random.default_rng(seed)
+    n_samples = int(round(sfreq * duration_sec))
+    times = start_time + np.arange(n_samples) / sfreq
+
+    # 1/f ノイズ（周波数領域で振幅を 1/sqrt(f) に整形）
+    spectrum = rng.standard_normal((n_channels, n_samples // 2 + 1)) + 1j * rng.standard_normal((n_channels, n_samples // 2 + 1))
+    freqs = np.fft.rfftfreq(n_samples, 1 / sfreq)
+    spectrum /= np.sqrt(np.maximum(freqs, 0.5))
+    data = np.fft.irfft(spectrum, n=n_samples, axis=1)
+    data *= 10.0 / data.std(axis=1, keepdims=True)
+    t = np.arange(n_samples) / sfreq
+    data += 5.0 * np.sin(2 * np.pi * 10.0 * t + rng.uniform(0, 2 * np.pi, (n_channels, 1)))
+    data += 2.0 * np.sin(2 * np.pi * 50.0 * t)
+
+    # 前頭部(先頭2ch)ほど強く出るように、チャンネルごとの重みを付ける
+    frontal_gain = np.where(np.arange(n_channels) < 2, 1.0, 0.3)
+    artifacts = []
+    n_blinks = rng.poisson(blink_rate_per_min * duration_sec / 60)
+    for onset in np.sort(rng.uniform(1.0, duration_sec - 1.0, n_blinks)):
+        width = rng.uniform(0.2, 0.4)
+        idx = np.arange(int(onset * sfreq), min(int((onset + width) * sfreq), n_samples))
+        bump = np.sin(np.pi * (idx / sfreq - onset) / width) ** 2 * rng.uniform(120, 250)
+        data[:, idx] += frontal_gain[:, None] * bump
+        artifacts.append({'kind': 'blink', 'start': float(times[0] + onset), 'end': float(times[0] + onset + width)})
+
+    n_emg = rng.poisson(emg_rate_per_min * duration_sec / 60)
+    for onset in np.sort(rng.uniform(1.0, duration_sec - 2.0, n_emg)):
+        length = rng.uniform(0.5, 1.0)
+        idx = np.arange(int(onset * sfreq), min(int((onset + length) * sfreq), n_samples))
+        burst = rng.standard_normal((n_channels, len(idx)))
+        burst = np.diff(burst, axis=1, prepend=0)  # 高域を強調した白色ノイズ
+        data[:, idx] += burst * rng.uniform(20, 40)
+        artifacts.append({'kind': 'emg', 'start': float(times[0] + onset), 'end': float(times[0] + onset + length)})
+
+    marker_times = start_time + np.arange(2.0, duration_sec - 1.0, marker_interval_sec)
+    return {
+        'data': np.ascontiguousarray(data.T, dtype=np.float32),
+        'times': times,
+        'sfreq': float(sfreq),
+        'ch_names': ['Fp1', 'Fp2'] + [f'Ch{i + 1}' for i in range(2, n_channels)],
+        'marker_times': marker_times,
+        'img_ids': np.arange(1, len(marker_times) + 1),
+        'artifacts': artifacts
+    }
+
+def _varlen(n):
+    if n < 2 ** 8: return struct.pack('<BB', 1, n)
+    if n < 2 ** 32: return struct.pack('<BI', 4, n)
+    return struct.pack('<BQ', 8, n)
+
+def _chunk(tag, content):
+    body = struct.pack('<H', tag) + content
+    return _varlen(len(body)) + body
+
+def _stream_header(stream_id, name, stream_type, channel_count, srate, channel_format, ch_names=None):
+    channels = ''.join(f"<channel><label>{ch}</label><unit>microvolts</unit><type>EEG</type></channel>" for ch in ch_names or [])
+    xml = (f'<?xml version="1.0"?><info><name>{name}</name><type>{stream_type}</type>'
+           f'<channel_count>{channel_count}</channel_count><nominal_srate>{srate}</nominal_srate>'
+           f'<channel_format>{channel_format}</channel_format><source_id>synth_{stream_id}</source_id>'
+           f'<desc><channels>{channels}</channels></desc></info>')
+    return _chunk(_TAG_STREAM_HEADER, struct.pack('<I', stream_id) + xml.encode('utf-8'))
+
+def _stream_footer(stream_id, first, last, count):
+    xml = (f'<?xml version="1.0"?><info><first_timestamp>{first}</first_timestamp><last_timestamp>{last}</last_timestamp>'
+           f'<sample_count>{count}</sample_count></info>')
+    return _chunk(_TAG_STREAM_FOOTER, struct.pack('<I', stream_id) + xml.encode('utf-8'))
+
+def _clock_offsets(stream_id, first, last):
+    return b''.join(_chunk(_TAG_CLOCK_OFFSET, struct.pack('<Idd', stream_id, t, 0.0)) for t in (first, last))
+
+def write_xdf(path, recording, label_channels=True):
+    """generate_recording() の結果をXDFファイル（EEG: float32, マーカー: JSON文字列）として書き出す"""
+    data, times = recording['data'], recording['times']
+    n_samples, n_channels = data.shape
+    # 1サンプル = タイムスタンプ有無(1byte) + タイムスタンプ(double) + 全チャンネルの値
+    sample_dtype = np.dtype([('has_ts', 'u1'), ('ts', '<f8'), ('values', '<f4', (n_channels,))])
+
+    with open(path, 'wb') as f:
+        f.write(b'XDF:')
+        f.write(_chunk(_TAG_FILE_HEADER, b'<?xml version="1.0"?><info><version>1.0</version></info>'))
+        f.write(_stream_header(1, 'SynthEEG', 'EEG', n_channels, recording['sfreq'], 'float32',
+                               recording['ch_names'] if label_channels else None))
+        f.write(_stream_header(2, 'SynthMarkers', 'Markers', 1, 0, 'string'))
+
+        for start in range(0, n_samples, _SAMPLES_PER_CHUNK):
+            stop = min(start + _SAMPLES_PER_CHUNK, n_samples)
+            samples = np.empty(stop - start, dtype=sample_dtype)
+            samples['has_ts'] = 8
+            samples['ts'] = times[start:stop]
+            samples['values'] = data[start:stop]
+            f.write(_chunk(_TAG_SAMPLES, struct.pack('<I', 1) + _varlen(stop - start) + samples.tobytes()))
+
+        content = bytearray(struct.pack('<I', 2) + _varlen(len(recording['marker_times'])))
+        for ts, img_id in zip(recording['marker_times'], recording['img_ids']):
+            value = json.dumps({'img_id': int(img_id)}).encode('utf-8')
+            content += struct.pack('<Bd', 8, ts) + _varlen(len(value)) + value
+        f.write(_chunk(_TAG_SAMPLES, bytes(content)))
+
+        f.write(_clock_offsets(1, times[0], times[-1]))
+        f.write(_clock_offsets(2, times[0], times[-1]))
+        f.write(_stream_footer(1, times[0], times[-1], n_samples))
+        f.write(_stream_footer(2, recording['marker_times'][0], recording['marker_times'][-1], len(recording['marker_times'])))
+
+def make_synthetic_xdf(path, label_channels=True, **kwargs):
+    """合成XDFを書き出し、正解情報付きの記録を返す"""
+    recording = generate_recording(**kwargs)
+    write_xdf(path, recording, label_channels)
+    return recording
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="アーチファクト入りの合成XDFファイルを生成します。")
+    parser.add_argument('path', help="出力するXDFファイル")
+    parser.add_argument('--sfreq', type=float, default=250)
+    parser.add_argument('--duration', type=float, default=600, help="記録時間(秒)")
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--marker-interval', type=float, default=12.0, help="マーカー間隔(秒)")
+    parser.add_argument('--blinks', type=float, default=6.0, help="まばたきの頻度(回/分)")
+    parser.add_argument('--emg', type=float, default=2.0, help="筋電バーストの頻度(回/分)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--truth', help="正解のアーチファクト位置を書き出すJSON")
+    args = parser.parse_args(argv)
+
+    recording = make_synthetic_xdf(args.path, sfreq=args.sfreq, duration_sec=args.duration, n_channels=args.channels,
+                                   marker_interval_sec=args.marker_interval, blink_rate_per_min=args.blinks,
+                                   emg_rate_per_min=args.emg, seed=args.seed)
+    if args.truth:
+        with open(args.truth, 'w', encoding='utf-8') as f: json.dump(recording['artifacts'], f, indent=2)
+    print(f"{args.path}: {recording['data'].shape[0]} サンプル x {recording['data'].shape[1]} ch, "
+          f"マーカー {len(recording['marker_times'])} 個, アーチファクト {len(recording['artifacts'])} 個")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import numpy as np
+
+class ThresholdIndex:
+    """
+    特徴量ごとのソート済み索引。スキャン完了時に1回だけ作成し、
+    閾値以上のウィンドウ数は二分探索、複数特徴量のOR条件はキャッシュ済みマスクの合成で求める。
+    """
+
+    def __init__(self, features_df, columns=None):
+        columns = [c for c in features_df.columns if c not in ['img_id', 'window_start_sec', 'window_end_sec']] if columns is None else columns
+        self.n_windows = len(features_df)
+        self._order, self._sorted = {}, {}
+        for col in columns:
+            # float32 の列はそのまま並べ替える（閾値との比較は features.rejection_mask と同じく列の型で行われる）
+            values = features_df[col].to_numpy()
+            if values.dtype.kind != 'f': values = values.astype(float)
+            order = np.argsort(values, kind='stable')
+            if len(order) < 2 ** 31: order = order.astype(np.int32)
+            sorted_values = values[order]
+            # NaN は末尾に並ぶので、比較対象から外す（NaN >= t は常に False）
+            n_valid = len(sorted_values) - int(np.isnan(sorted_values).sum())
+            self._order[col] = order[:n_valid]
+            self._sorted[col] = sorted_values[:n_valid]
+        self._mask_cache = {}
+        self._combined_cache = (None, None)
+
+    @property
+    def columns(self):
+        return list(self._sorted)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self._order.values()) + sum(a.nbytes for a in self._sorted.values())
+
+    def count_exceeding(self, col, threshold):
+        """threshold 以上のウィンドウ数"""
+        sorted_values = self._sorted[col]
+        return len(sorted_values) - int(np.searchsorted(sorted_values, threshold, side='left'))
+
+    def quantile(self, col, q):
+        """pandas の Series.quantile（線形補間、NaN除外）と同じ値をソート済み配列から直接求める"""
+        sorted_values = self._sorted[col]
+        if len(sorted_values) == 0: return np.nan
+        pos = q * (len(sorted_values) - 1)
+        lo = int(np.floor(pos)); hi = min(lo + 1, len(sorted_values) - 1)
+        return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+    def mask(self, col, threshold):
+        """threshold 以上のウィンドウを True とするマスク（特徴量ごとに直近の閾値分をキャッシュ）"""
+        cached = self._mask_cache.get(col)
+        if cached is not None and cached[0] == threshold: return cached[1]
+        start = int(np.searchsorted(self._sorted[col], threshold, side='left'))
+        mask = np.zeros(self.n_windows, dtype=bool)
+        mask[self._order[col][start:]] = True
+        self._mask_cache[col] = (threshold, mask)
+        return mask
+
+    def rejection_mask(self, thresholds):
+        """いずれか1つでも閾値以上になったウィンドウを True とするマスク（features.rejection_mask と同じ判定）"""
+        key = tuple(sorted(thresholds.items()))
+        if self._combined_cache[0] == key: return self._combined_cache[1]
+        combined = np.zeros(self.n_windows, dtype=bool)
+        for col, threshold in thresholds.items():
+            combined |= self.mask(col, threshold)
+        self._combined_cache = (key, combined)
+        return combined
+
+    def rejection_curve(self, col, n_points=200):
+        """閾値と除去されるウィンドウの割合の関係（閾値はデータの分位点から n_points 個）"""
+        sorted_values = self._sorted[col]
+        if len(sorted_values) == 0 or self.n_windows == 0: return np.array([]), np.array([])
+        thresholds = np.unique(sorted_values[np.linspace(0, len(sorted_values) - 1, n_points).astype(int)])
+        counts = len(sorted_values) - np.searchsorted(sorted_values, thresholds, side='left')
+        return thresholds, counts / self.n_windows
@@ -1,36 +1,63 @@
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
-import streamlit as st
+import numpy as np
 import plotly.express as px
+from rejection import merge_intervals
+from instrumentation import timed
+
+# 波形1本あたりの最大描画点数（プロット幅 約1000px × 2点/px）
+WAVEFORM_MAX_POINTS = 2000
+# これを超える点数の散布図は WebGL で描画する
+SCATTERGL_THRESHOLD = 5000
 
 def _merge_overlapping_intervals(df):
     """重なり合う時間区間を統合するヘルパー関数"""
     if df.empty: return []
-    df = df.sort_values('second').reset_index(drop=True)
-    merged = []
-    if len(df) > 0:
-        current_start, current_end = df.loc[0, 'second'], df.loc[0, 'second_end']
-        for i in range(1, len(df)):
-            next_start, next_end = df.loc[i, 'second'], df.loc[i, 'second_end']
-            if next_start < current_end:
-                current_end = max(current_end, next_end)
-            else:
-                merged.append({'start': current_start, 'end': current_end})
-                current_start, current_end = next_start, next_end
-        merged.append({'start': current_start, 'end': current_end})
-    return merged
+    starts, ends = merge_intervals(df['second'].to_numpy(), df['second_end'].to_numpy())
+    return [{'start': start, 'end': end} for start, end in zip(starts, ends)]
+
+def minmax_decimate(x, y, max_points=WAVEFORM_MAX_POINTS):
+    """
+    min-max 間引き: 区間ごとに最小値と最大値の2点だけを時間順に残す。
+    瞬間的なスパイク（まばたき等）の高さを保ったまま点数を max_points 程度に減らす。
+    """
+    n = len(y)
+    n_buckets = max(max_points // 2, 1)
+    if n <= max_points: return x, y
+    bucket = -(-n // n_buckets)
+    # 末尾を最後の値で埋めて (n_buckets, bucket) に整形し、区間ごとの最小・最大位置を一括で求める
+    padded = np.concatenate([y, np.full(n_buckets * bucket - n, y[-1])]).reshape(n_buckets, bucket)
+    offsets = np.arange(n_buckets) * bucket
+    i_min = np.minimum(offsets + padded.argmin(axis=1), n - 1)
+    i_max = np.minimum(offsets + padded.argmax(axis=1), n - 1)
+    idx = np.column_stack([np.minimum(i_min, i_max), np.maximum(i_min, i_max)]).ravel()
+    return x[idx], y[idx]
+
+def figure_payload_bytes(fig):
+    """ブラウザへ送られる図のJSONサイズ（バイト）"""
+    return len(fig.to_json())
 
-def plot_waveforms(epoch_data, display_mode="重ねて", outlier_df=None):
-    """生波形とフィルター後波形をプロットし、除去区間をハイライトする"""
+@timed('plot.waveforms')
+def plot_waveforms(epoch_data, display_mode="重ねて", outlier_df=None, max_points=WAVEFORM_MAX_POINTS, x_range=None):
+    """
+    生波形とフィルター後波形をプロットし、除去区間をハイライトする。
+    波形は min-max 間引きで max_points 点程度に抑え、x_range を指定するとその範囲だけを高解像度で描画する。
+    """
     raw, filtered, times = epoch_data['raw'], epoch_data['filtered'], epoch_data['times']
-    ch_names = ['Fp1', 'Fp2']
+    if x_range is not None:
+        lo, hi = np.searchsorted(times, x_range[0], side='left'), np.searchsorted(times, x_range[1], side='right')
+        raw, filtered, times = raw[:, lo:hi], filtered[:, lo:hi], times[lo:hi]
+    ch_names = epoch_data.get('ch_names', ['Fp1', 'Fp2'])
     colors = px.colors.qualitative.Plotly
-    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, subplot_titles=ch_names, vertical_spacing=0.1)
+    n_rows = len(ch_names) if display_mode == "並べて" else 1
+    fig = make_subplots(rows=n_rows, cols=1, shared_xaxes=True, subplot_titles=ch_names if display_mode == "並べて" else None, vertical_spacing=min(0.1, 0.3 / n_rows))
 
     for i, ch in enumerate(ch_names):
-        fig.add_trace(go.Scatter(x=times, y=raw[i], mode='lines', name=f'{ch} (生)', legendgroup=ch, line_color=colors[i], opacity=0.4, showlegend=(i==0)), row=i+1 if display_mode=="並べて" else 1, col=1)
-        fig.add_trace(go.Scatter(x=times, y=filtered[i], mode='lines', name=f'{ch} (フィルター後)', legendgroup=ch, line_color=colors[i], showlegend=(i==0)), row=i+1 if display_mode=="並べて" else 1, col=1)
+        raw_x, raw_y = minmax_decimate(times, raw[i], max_points)
+        filt_x, filt_y = minmax_decimate(times, filtered[i], max_points)
+        fig.add_trace(go.Scatter(x=raw_x, y=raw_y, mode='lines', name=f'{ch} (生)', legendgroup=ch, line_color=colors[i % len(colors)], opacity=0.4, showlegend=(i==0)), row=i+1 if display_mode=="並べて" else 1, col=1)
+        fig.add_trace(go.Scatter(x=filt_x, y=filt_y, mode='lines', name=f'{ch} (フィルター後)', legendgroup=ch, line_color=colors[i % len(colors)], showlegend=(i==0)), row=i+1 if display_mode=="並べて" else 1, col=1)
     
     if outlier_df is not None and not outlier_df.empty:
         merged_intervals = _merge_overlapping_intervals(outlier_df)
@@ -41,13 +68,15 @@ def plot_waveforms(epoch_data, display_mode="重ねて", outlier_df=None):
             fig.add_vrect(x0=marker_relative_start, x1=marker_relative_end, fillcolor="rgba(255, 100, 100, 0.25)", layer="below", line_width=0)
 
     fig.add_vline(x=0, line_dash="dash", line_color="red", annotation_text="Marker")
-    fig.update_layout(height=500, template="plotly_white", hovermode="x unified", legend_orientation="h")
+    fig.update_layout(height=max(500, 200 * n_rows), template="plotly_white", hovermode="x unified", legend_orientation="h")
     title_text = "EEG波形比較（重ねて表示）" if display_mode == "重ねて" else "EEG波形比較（並べて表示）"
     fig.update_layout(title=title_text)
     fig.update_yaxes(title_text="振幅 (μV)")
+    if x_range is not None: fig.update_xaxes(range=list(x_range))
     return fig
 
 # ★★ ここを修正 ★★
+@timed('plot.scatter')
 def plot_outlier_scatter(data, x_col, y_col, color_col, x_thresh=None, y_thresh=None):
     """
     外れ値検出のための散布図を、指定された列で色分けして描画する
@@ -63,6 +92,7 @@ def plot_outlier_scatter(data, x_col, y_col, color_col, x_thresh=None, y_thresh=
     fig = px.scatter(clean_data, x=x_col, y=y_col,
                      color=color_col,  # ← 色分けの列を指定
                      hover_data=['img_id', 'window_start_sec'],
+                     render_mode='webgl' if len(clean_data) > SCATTERGL_THRESHOLD else 'svg',
                      title=f"<b>{x_col}</b> vs <b>{y_col}</b> (色: {color_col})")
     
     if x_thresh is not None: fig.add_vline(x=x_thresh, line_dash="dash", line_color="red")
@@ -70,3 +100,20 @@ def plot_outlier_scatter(data, x_col, y_col, color_col, x_thresh=None, y_thresh=
     
     fig.update_layout(template="plotly_white", height=500)
     return fig
+
+@timed('plot.rejection_curves')
+def plot_rejection_curves(threshold_index, columns, thresholds=None, n_cols=3):
+    """特徴量ごとの「閾値 vs 除去されるウィンドウの割合」曲線を並べて描画する"""
+    thresholds = thresholds or {}
+    n_rows = -(-len(columns) // n_cols)
+    fig = make_subplots(rows=n_rows, cols=n_cols, subplot_titles=columns, vertical_spacing=0.15)
+    for i, col in enumerate(columns):
+        row, col_pos = i // n_cols + 1, i % n_cols + 1
+        x, y = threshold_index.rejection_curve(col)
+        fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=col, showlegend=False), row=row, col=col_pos)
+        if col in thresholds:
+            fig.add_vline(x=thresholds[col], line_dash="dash", line_color="red", row=row, col=col_pos)
+    fig.update_xaxes(type="log")
+    fig.update_yaxes(tickformat=".0%", range=[0, 1])
+    fig.update_layout(template="plotly_white", height=300 * n_rows, title="閾値と除去率の関係")
+    return fig